@@ -17,8 +17,9 @@ const QUALTRICS_URL_PATTERNS = [
   "*://*.eu.qualtrics.com/*/*",
   "*://leidenuniv.eu.qualtrics.com/*/*"
 ];
-const BATCH_SIZE = 1;
+const BATCH_SIZE = 100;
 const FLUSH_INTERVAL_MS = 3000;
+const MAX_BATCH_EVENTS = 500;
 const LOG_STATE_KEY = "__qtrack_log_state";
 const ALLOWED_TRANSITIONS = [
   "link", "generated", "form_submit", "auto_bookmark",
@@ -569,23 +570,96 @@ async function enqueue(entry) {
   }
 }
 
-async function flush() {
-  if (!collectorUrl || queue.length === 0) return;
-  const batch = queue.splice(0, queue.length);
-  console.log("[tracker] flushing", batch.length, "events to", collectorUrl);
+function ingestV2Url(url) {
   try {
-    const payload = {
-      events: batch.map(({ __logId, ...event }) => event)
-    };
-    const resp = await fetch(collectorUrl, {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify(payload)
+    const parsed = new URL(url);
+    parsed.pathname = parsed.pathname.replace(/\/ingest\/?$/, "/v2/ingest");
+    return parsed.toString();
+  } catch {
+    return null;
+  }
+}
+
+async function gzipText(text) {
+  if (typeof CompressionStream !== "function") return null;
+  const stream = new Blob([text]).stream().pipeThrough(new CompressionStream("gzip"));
+  return await new Response(stream).arrayBuffer();
+}
+
+// v2 batches are gzip-compressed NDJSON tagged with a per-client sequence
+// number. A batch stays in `inflightBatch` until the collector acknowledges
+// its sequence number, and retries resend the same batch; the collector
+// dedupes on logId, so a retry never produces duplicate rows.
+const ingestClientId = generateLogId();
+let batchSeq = 0;
+let inflightBatch = null;
+let flushInProgress = null;
+let ingestV2Supported = true;
+
+async function postBatchV2(batch) {
+  const url = ingestV2Url(collectorUrl);
+  if (!url) return false;
+  const ndjson = batch.events.map((event) => JSON.stringify(event)).join("\n") + "\n";
+  const gz = await gzipText(ndjson);
+  const headers = {
+    "Content-Type": "application/x-ndjson",
+    "X-Client-Id": ingestClientId,
+    "X-Batch-Seq": String(batch.seq)
+  };
+  if (gz) headers["Content-Encoding"] = "gzip";
+  const resp = await fetch(url, { method: "POST", headers, body: gz || ndjson });
+  if (resp.status === 404) {
+    console.warn("[tracker] collector has no /v2/ingest; falling back to v1");
+    ingestV2Supported = false;
+    return false;
+  }
+  if (!resp.ok) throw new Error(`Collector responded with ${resp.status}`);
+  const ack = await resp.json();
+  if (ack?.ack !== batch.seq) throw new Error(`Collector acknowledged ${ack?.ack}, expected ${batch.seq}`);
+  console.log("[tracker] batch", batch.seq, "acknowledged:", ack.written, "written,", ack.duplicates, "duplicates");
+  return true;
+}
+
+async function postBatchV1(batch) {
+  const resp = await fetch(collectorUrl, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ events: batch.events })
+  });
+  console.log("[tracker] upload status", resp.status);
+  if (!resp.ok) throw new Error(`Collector responded with ${resp.status}`);
+}
+
+// One flush at a time: the timer and enqueue() both call flush(), and a
+// second call while a POST is pending just waits for that one.
+function flush() {
+  if (!flushInProgress) {
+    flushInProgress = flushOnce().finally(() => {
+      flushInProgress = null;
     });
-    console.log("[tracker] upload status", resp.status);
+  }
+  return flushInProgress;
+}
+
+async function flushOnce() {
+  if (!collectorUrl) return;
+  if (!inflightBatch) {
+    if (queue.length === 0) return;
+    const events = queue.splice(0, MAX_BATCH_EVENTS);
+    inflightBatch = {
+      seq: ++batchSeq,
+      events: events.map(({ __logId, ...event }) => ({ ...event, logId: __logId }))
+    };
+  }
+  const batch = inflightBatch;
+  console.log("[tracker] flushing", batch.events.length, "events (seq", batch.seq, ") to", collectorUrl);
+  try {
+    const sent = ingestV2Supported && await postBatchV2(batch);
+    if (!sent) await postBatchV1(batch);
+    // The batch may have been dropped meanwhile (new responseId).
+    if (inflightBatch === batch) inflightBatch = null;
   } catch (e) {
-    console.warn("[tracker] upload failed", e);
-    queue.unshift(...batch);
+    console.warn("[tracker] upload failed; will retry batch", batch.seq, e);
   }
 }
 setInterval(flush, FLUSH_INTERVAL_MS);
@@ -683,6 +757,7 @@ async function resetLogState(newResponseId = null) {
     updatedAt: nowIso
   };
   queue.length = 0;
+  inflightBatch = null;
   await persistLogState();
 }
 
@@ -762,6 +837,9 @@ async function getLogReviewSnapshot() {
 
 function purgeQueuedEntriesById(logId) {
   if (!logId) return;
+  if (inflightBatch) {
+    inflightBatch.events = inflightBatch.events.filter((event) => event.logId !== logId);
+  }
   if (!Array.isArray(queue) || queue.length === 0) return;
   for (let i = queue.length - 1; i >= 0; i -= 1) {
     if (queue[i]?.__logId === logId) {
@@ -782,7 +860,7 @@ async function uploadLogSnapshot(entries, meta = {}) {
   const payloadEvents = Array.isArray(entries)
     ? entries.map((entry) => {
         const { __logId, ...event } = toUploadEvent(entry);
-        return event;
+        return { ...event, logId: __logId };
       })
     : [];
 
@@ -1,24 +1,117 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
-import csv, os
+import argparse, atexit, functools, json, os, signal, sqlite3, sys, threading, time, zlib
+from collections import OrderedDict
+
+# metrics.py lives at the repository root, next to app.py.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics import Counter, Histogram, REGISTRY, CONTENT_TYPE, span
+
+from snapshot_store import SnapshotStore
+from event_index import EventIndex
 
 SAVE_DIR = "QualtricsTracker/logs"   
 os.makedirs(SAVE_DIR, exist_ok=True)
-HEADER = ["timestamp_iso","url","question_id","source","search_results"]
+COMPACT_DELAY = float(os.getenv("COLLECTOR_COMPACT_DELAY", "2.0"))
+MAX_BATCH_BYTES = int(os.getenv("COLLECTOR_MAX_BATCH_BYTES", str(16 * 1024 * 1024)))
+MAX_TRACKED_CLIENTS = 10000
+DRAIN_TIMEOUT = float(os.getenv("COLLECTOR_DRAIN_TIMEOUT", "30"))
+# SQLite index behind the /query endpoints; an empty value disables both.
+INDEX_PATH = os.getenv("COLLECTOR_INDEX_PATH", os.path.join(SAVE_DIR, "_index.sqlite"))
+
+query_index = EventIndex(INDEX_PATH, SAVE_DIR) if INDEX_PATH else None
+store = SnapshotStore(SAVE_DIR, compact_delay=COMPACT_DELAY, index=query_index)
+if query_index is not None:
+    atexit.register(query_index.close)
+atexit.register(store.close)
+
+INDEX_REPAIR_INTERVAL = float(os.getenv("COLLECTOR_INDEX_REPAIR_INTERVAL", "5"))
+
+# Catches up with CSVs written while the collector was not maintaining the
+# index, then re-reads responseIds whose index update failed. Queries answer
+# meanwhile, from what is indexed so far, with complete=false.
+_index_reconciled = threading.Event()
+
+def _maintain_index():
+    while True:
+        try:
+            if not _index_reconciled.is_set():
+                query_index.reconcile(store.lock)
+                _index_reconciled.set()
+            elif query_index.dirty():
+                left = query_index.repair(store.lock)
+                print(f"[collector] index repaired, {left} responses still dirty", flush=True)
+        except (OSError, sqlite3.Error) as e:
+            print(f"[collector] index maintenance failed: {e}", flush=True)
+        time.sleep(INDEX_REPAIR_INTERVAL)
+
+if query_index is not None:
+    threading.Thread(target=_maintain_index, name="index-maintenance", daemon=True).start()
+
+INGEST_SECONDS = Histogram("collector_ingest_seconds", "Time spent handling /ingest requests.")
+INGEST_REQUESTS = Counter("collector_ingest_requests_total", "/ingest requests by mode.", ["mode"])
+INGEST_ROWS = Counter("collector_ingest_rows_total", "CSV rows written by /ingest, by mode.", ["mode"])
+INGEST_V2_SECONDS = Histogram("collector_ingest_v2_seconds", "Time spent handling /v2/ingest batches.")
+QUERY_SECONDS = Histogram("collector_query_seconds", "Time spent answering /query requests.", ["endpoint"])
+INGEST_V2_EVENTS = Counter("collector_ingest_v2_events_total", "Events received by /v2/ingest, by outcome.", ["outcome"])
+
+# Highest batch sequence number acknowledged per client id.
+_acks = OrderedDict()
+_acks_lock = threading.Lock()
 
 app = Flask(__name__)
 CORS(app)
 
+# Ingest requests currently being handled; graceful shutdown waits for zero.
+_inflight = 0
+_inflight_cond = threading.Condition()
+_draining = threading.Event()
+
+def tracked(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        global _inflight
+        if request.method == "OPTIONS":
+            return view(*args, **kwargs)
+        if _draining.is_set():
+            return jsonify(ok=False, error="collector is shutting down"), 503, {"Retry-After": "5"}
+        with _inflight_cond:
+            _inflight += 1
+        try:
+            return view(*args, **kwargs)
+        finally:
+            with _inflight_cond:
+                _inflight -= 1
+                _inflight_cond.notify_all()
+    return wrapper
+
 @app.get("/")
 def index():
     return "URL Tracker collector is running. POST JSON to /ingest", 200
 
+@app.get("/ready")
+def ready():
+    if _draining.is_set():
+        return jsonify(ready=False, reason="draining"), 503
+    if not os.access(SAVE_DIR, os.W_OK):
+        return jsonify(ready=False, reason=f"{SAVE_DIR} is not writable"), 503
+    return jsonify(ready=True, inflight=_inflight, index_reconciled=_index_reconciled.is_set()), 200
+
+@app.get("/metrics")
+def metrics():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
 @app.route("/ingest", methods=["POST", "OPTIONS"])
 @app.route("/ingest/", methods=["POST", "OPTIONS"])
+@tracked
 def ingest():
     if request.method == "OPTIONS":
         return ("", 204)
 
+    with span(INGEST_SECONDS):
+        return _ingest()
+
+def _ingest():
     data = request.get_json(silent=True) or {}
     events = data.get("events", []) or []
     meta = data.get("meta") or {}
@@ -33,8 +126,6 @@ def ingest():
     if removed_count is None:
         removed_count = meta.get("removedCount")
 
-    print(f"[collector] received {len(events)} events", flush=True)
-
     events_by_id = {}
     for ev in events:
         rid = ev.get("responseId") or response_hint
@@ -45,51 +136,199 @@ def ingest():
     if overwrite and response_hint and response_hint not in events_by_id:
         events_by_id[response_hint] = []
 
-    total_written = 0
-
     for rid, items in events_by_id.items():
-        path = os.path.join(SAVE_DIR, f"{rid}.csv")
-        mode = "w" if overwrite else "a"
-        is_new = overwrite or not os.path.exists(path)
-
-        with open(path, mode, newline="", encoding="utf-8") as f:
-            w = csv.writer(f)
-            if is_new:
-                w.writerow(HEADER)
-
-            for ev in items:
-                search_results = ev.get("searchResults")
-                if isinstance(search_results, list):
-                    search_str = " | ".join(str(item) for item in search_results)
-                elif search_results is None:
-                    search_str = ""
-                else:
-                    search_str = str(search_results)
-
-                w.writerow([
-                    ev.get("ts"),
-                    ev.get("url"),
-                    ev.get("questionId"),
-                    ev.get("source"),
-                    search_str,
-                ])
-                total_written += 1
-
-        action = "overwrite" if overwrite else "append"
-        print(f"[collector] {action} {len(items)} rows for {rid}", flush=True)
-
-    if overwrite and not events_by_id and response_hint:
-        # No items but request asked for overwrite; create/clear file with header only.
-        path = os.path.join(SAVE_DIR, f"{response_hint}.csv")
-        with open(path, "w", newline="", encoding="utf-8") as f:
-            csv.writer(f).writerow(HEADER)
-        print(f"[collector] overwrite 0 rows for {response_hint}", flush=True)
+        if overwrite:
+            result = store.sync(rid, items)
+            INGEST_ROWS.inc(result["inserted"], mode="overwrite")
+            how = "rewrote" if result["rewritten"] else "synced"
+            print(f"[collector] overwrite {rid}: {how}, +{result['inserted']} -{result['deleted']} rows", flush=True)
+        else:
+            written = store.append(rid, items)
+            INGEST_ROWS.inc(written, mode="append")
 
     if overwrite and removed_count is not None:
         print(f"[collector] participant removed {removed_count} entries before sync", flush=True)
 
-    print(f"[collector] total rows processed: {total_written}", flush=True)
+    INGEST_REQUESTS.inc(mode="overwrite" if overwrite else "append")
     return jsonify(ok=True, saved=len(events))
 
+class BadBatch(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def _read_batch_body():
+    if request.content_length is not None and request.content_length > MAX_BATCH_BYTES:
+        raise BadBatch("batch too large", 413)
+    raw = request.get_data(cache=False)
+    if request.headers.get("Content-Encoding", "").lower() == "gzip":
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            body = inflater.decompress(raw, MAX_BATCH_BYTES + 1)
+        except zlib.error:
+            raise BadBatch("body is not valid gzip")
+        if len(body) > MAX_BATCH_BYTES or inflater.unconsumed_tail:
+            raise BadBatch("batch too large", 413)
+        if not inflater.eof:
+            raise BadBatch("truncated gzip body")
+        raw = body
+    return raw.decode("utf-8", errors="replace")
+
+@app.route("/v2/ingest", methods=["POST", "OPTIONS"])
+@tracked
+def ingest_v2():
+    # Batched ingest: gzip-compressed (optional) NDJSON, one event per line,
+    # spanning any number of responseIds. Every event needs a responseId and
+    # a logId; rows already stored for that logId are skipped, so clients can
+    # resend an unacknowledged batch without creating duplicates.
+    if request.method == "OPTIONS":
+        return ("", 204)
+
+    with span(INGEST_V2_SECONDS):
+        try:
+            seq = int(request.headers.get("X-Batch-Seq", ""))
+        except ValueError:
+            return jsonify(ok=False, error="X-Batch-Seq header must be an integer"), 400
+        client_id = request.headers.get("X-Client-Id") or request.remote_addr or ""
+
+        try:
+            body = _read_batch_body()
+        except BadBatch as e:
+            return jsonify(ok=False, ack=None, error=str(e)), e.status
+
+        events_by_id = {}
+        accepted = rejected = 0
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                ev = json.loads(line)
+            except ValueError:
+                rejected += 1
+                continue
+            if not isinstance(ev, dict) or not ev.get("responseId") or not ev.get("logId"):
+                rejected += 1
+                continue
+            events_by_id.setdefault(ev["responseId"], []).append(ev)
+            accepted += 1
+
+        written = 0
+        for rid, items in events_by_id.items():
+            written += store.append(rid, items)
+
+        with _acks_lock:
+            replay = seq <= _acks.get(client_id, 0)
+            _acks[client_id] = max(seq, _acks.get(client_id, 0))
+            _acks.move_to_end(client_id)
+            while len(_acks) > MAX_TRACKED_CLIENTS:
+                _acks.popitem(last=False)
+
+        INGEST_ROWS.inc(written, mode="batch")
+        INGEST_V2_EVENTS.inc(written, outcome="written")
+        INGEST_V2_EVENTS.inc(accepted - written, outcome="duplicate")
+        INGEST_V2_EVENTS.inc(rejected, outcome="rejected")
+        print(f"[collector] batch {client_id}#{seq}: {written} written, {accepted - written} duplicates, "
+              f"{rejected} rejected across {len(events_by_id)} responses", flush=True)
+        return jsonify(ok=True, ack=seq, replay=replay, accepted=accepted, written=written,
+                       duplicates=accepted - written, rejected=rejected)
+
+def query(endpoint):
+    # Read-only views over the index. "complete" is false until the startup
+    # reconcile has caught up with CSVs written while the collector was down,
+    # and while a failed index update waits for repair.
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if query_index is None:
+                return jsonify(ok=False, error="the query index is disabled (COLLECTOR_INDEX_PATH)"), 503
+            with span(QUERY_SECONDS, endpoint=endpoint):
+                try:
+                    result = view(*args, **kwargs)
+                except sqlite3.Error as e:
+                    return jsonify(ok=False, error=f"index query failed: {e}"), 500
+            return jsonify(ok=True, complete=_index_reconciled.is_set() and not query_index.dirty(), **result)
+        return wrapper
+    return decorator
+
+@app.get("/query/responses/<rid>")
+@query("response")
+def query_response(rid):
+    return {"responseId": rid, "events": query_index.events(rid)}
+
+@app.get("/query/questions")
+@query("questions")
+def query_questions():
+    return {"questions": query_index.questions()}
+
+@app.get("/query/questions/<question_id>")
+@query("question")
+def query_question(question_id):
+    # ?search=1: only responses with search-engine events; ?engine=google: one engine.
+    engine = request.args.get("engine") or ("" if request.args.get("search") in ("1", "true") else None)
+    return {"questionId": question_id, "engine": engine, "responses": query_index.question(question_id, engine)}
+
+@app.get("/query/sources")
+@query("sources")
+def query_sources():
+    question_id = request.args.get("question")
+    return {"questionId": question_id, "sources": query_index.sources(question_id)}
+
+def drain(timeout=DRAIN_TIMEOUT):
+    # Stops accepting ingests, waits for in-flight ones, then flushes pending
+    # compactions. Returns False if requests were still running at the timeout.
+    _draining.set()
+    deadline = time.monotonic() + timeout
+    with _inflight_cond:
+        while _inflight:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            _inflight_cond.wait(left)
+        drained = _inflight == 0
+    store.close()
+    return drained
+
+def serve(host, port, threads):
+    # Production mode: a multi-threaded waitress server. Requests for
+    # different responseIds run in parallel; writes to the same CSV are
+    # serialized by the store's per-responseId lock, which is why this is one
+    # process with many threads rather than several processes.
+    try:
+        from waitress import create_server
+    except ImportError:
+        sys.exit("--serve needs waitress: pip install waitress")
+
+    server = create_server(app, host=host, port=port, threads=threads,
+                           connection_limit=max(100, threads * 16), channel_timeout=30)
+    stop = threading.Event()
+
+    def _on_signal(signum, frame):
+        print(f"[collector] received signal {signum}, draining", flush=True)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, _on_signal)
+    signal.signal(signal.SIGINT, _on_signal)
+
+    loop = threading.Thread(target=server.run, name="waitress", daemon=True)
+    loop.start()
+    print(f"[collector] serving on http://{host}:{port} with {threads} threads", flush=True)
+    while not stop.wait(1.0):
+        pass
+
+    drained = drain()
+    print(f"[collector] drain {'complete' if drained else 'timed out'}", flush=True)
+    # Stops listening; the daemon server thread ends with the process.
+    server.close()
+    loop.join(timeout=1)
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080)
+    parser = argparse.ArgumentParser(description="Qualtrics URL tracker collector.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--serve", action="store_true", help="run the multi-threaded production server")
+    parser.add_argument("--threads", type=int, default=int(os.getenv("COLLECTOR_THREADS", "32")))
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.host, args.port, args.threads)
+    else:
+        app.run(host=args.host, port=args.port)
@@ -0,0 +1,257 @@
+import csv, os, re, sqlite3, threading
+from urllib.parse import parse_qs, urlsplit
+
+from snapshot_store import HEADER, LOG_ID_COLUMN
+
+# SQLite index over the collector's CSVs, so the query endpoints never scan
+# them. SnapshotStore updates it under the responseId lock after every write:
+# appended rows are added, tombstoned ids are removed straight away (before
+# compaction drops them from the CSV) and full rewrites replace the
+# responseId's rows. Each responseId's CSV (and .tomb) size and mtime are
+# recorded with it; reconcile() re-reads any CSV that changed without the
+# index seeing it, e.g. files from before the index existed or a crash
+# between the CSV write and the index update. A responseId whose update
+# failed is marked dirty until repair() has re-read it.
+
+# Mirrors SEARCH_ENGINES in background.js.
+SEARCH_ENGINES = (
+    ("google", re.compile(r"(^|\.)google\.[a-z.]+$", re.I), "q", re.compile(r"^/search", re.I)),
+    ("bing", re.compile(r"(^|\.)bing\.com$", re.I), "q", re.compile(r"^/(search|images/search)", re.I)),
+    ("duckduckgo", re.compile(r"(^|\.)duckduckgo\.com$", re.I), "q", None),
+    ("yahoo", re.compile(r"(^|\.)search\.yahoo\.com$", re.I), "p", re.compile(r"^/search", re.I)),
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    rid TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    ts TEXT,
+    url TEXT,
+    question_id TEXT,
+    source TEXT,
+    engine TEXT,
+    search_results TEXT,
+    log_id TEXT,
+    PRIMARY KEY (rid, seq)
+);
+CREATE INDEX IF NOT EXISTS events_log_id ON events (rid, log_id);
+CREATE INDEX IF NOT EXISTS events_question ON events (question_id, engine, rid);
+CREATE INDEX IF NOT EXISTS events_source ON events (source, engine, rid);
+CREATE TABLE IF NOT EXISTS files (
+    rid TEXT PRIMARY KEY,
+    signature TEXT NOT NULL
+);
+"""
+
+def engine_for(url):
+    # Name of the search engine if url is a results page, else "".
+    try:
+        parts = urlsplit(url or "")
+    except ValueError:
+        return ""
+    if parts.scheme not in ("http", "https"):
+        return ""
+    host = parts.hostname or ""
+    for name, host_re, param, path_re in SEARCH_ENGINES:
+        if not host_re.search(host):
+            continue
+        if path_re is not None and not path_re.search(parts.path):
+            continue
+        if not parse_qs(parts.query).get(param):
+            continue
+        return name
+    return ""
+
+def _row(row):
+    # Appended rows come from event_row() and may hold None; rows re-read
+    # from the CSV hold "". Store both as "" so they group together.
+    row = (["" if v is None else str(v) for v in row] + [""] * len(HEADER))[:len(HEADER)]
+    ts, url, question_id, source, search_results, log_id = row
+    return ts, url, question_id, source, engine_for(url), search_results, log_id
+
+class EventIndex:
+
+    def __init__(self, db_path, save_dir):
+        self.db_path = db_path
+        self.save_dir = save_dir
+        self._write_lock = threading.Lock()
+        self._dirty = set()
+        self._local = threading.local()
+        self._db = self._connect()
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _reader(self):
+        # One connection per request thread; WAL lets reads run during writes.
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = self._connect()
+            db.row_factory = sqlite3.Row
+        return db
+
+    def _signature(self, rid):
+        path = os.path.join(self.save_dir, f"{rid}.csv")
+        parts = []
+        for p in (path, path + ".tomb"):
+            try:
+                st = os.stat(p)
+                parts.append(f"{st.st_size}:{st.st_mtime_ns}")
+            except FileNotFoundError:
+                parts.append("-")
+        return "|".join(parts)
+
+    def _write(self, rid, fn):
+        # Index failures must not fail the ingest. The responseId is marked
+        # dirty for repair(), and the missing signature makes reconcile()
+        # redo it after a restart.
+        with self._write_lock:
+            try:
+                with self._db:
+                    fn(self._db)
+                    self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?)", (rid, self._signature(rid)))
+            except sqlite3.Error as e:
+                print(f"[collector] index update failed for {rid}: {e}", flush=True)
+                self._dirty.add(rid)
+                try:
+                    with self._db:
+                        self._db.execute("DELETE FROM files WHERE rid = ?", (rid,))
+                except sqlite3.Error:
+                    pass
+            else:
+                self._dirty.discard(rid)
+
+    def dirty(self):
+        # True while some responseId's rows may be wrong.
+        with self._write_lock:
+            return bool(self._dirty)
+
+    def _read_csv(self, rid):
+        # (rows, tombstones) of the responseId's CSV; raises FileNotFoundError.
+        path = os.path.join(self.save_dir, f"{rid}.csv")
+        with open(path, newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            rows = list(reader)
+        if header != HEADER:
+            # Legacy file: same leading columns, no log ids.
+            rows = [(row + [""] * len(HEADER))[:LOG_ID_COLUMN] + [""] for row in rows]
+        tombstones = set()
+        if os.path.exists(path + ".tomb"):
+            with open(path + ".tomb", encoding="utf-8") as f:
+                tombstones = {line.strip() for line in f if line.strip()}
+        return rows, tombstones
+
+    def _drop(self, rids):
+        with self._write_lock, self._db:
+            self._db.executemany("DELETE FROM events WHERE rid = ?", [(r,) for r in rids])
+            self._db.executemany("DELETE FROM files WHERE rid = ?", [(r,) for r in rids])
+            self._dirty.difference_update(rids)
+
+    # -- maintenance (callers hold the responseId's lock) -------------------
+
+    def add(self, rid, rows):
+        def fn(db):
+            start = db.execute("SELECT COALESCE(MAX(seq) + 1, 0) FROM events WHERE rid = ?", (rid,)).fetchone()[0]
+            db.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           [(rid, start + i, *_row(row)) for i, row in enumerate(rows)])
+        self._write(rid, fn)
+
+    def remove(self, rid, log_ids):
+        def fn(db):
+            db.executemany("DELETE FROM events WHERE rid = ? AND log_id = ?", [(rid, i) for i in log_ids])
+        self._write(rid, fn)
+
+    def replace(self, rid, rows, tombstones=()):
+        def fn(db):
+            db.execute("DELETE FROM events WHERE rid = ?", (rid,))
+            live = [r for r in map(_row, rows) if not (tombstones and r[-1] in tombstones)]
+            db.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           [(rid, i, *r) for i, r in enumerate(live)])
+        self._write(rid, fn)
+
+    def reconcile(self, lock):
+        # Re-reads every CSV whose signature differs from the recorded one and
+        # drops responseIds whose CSV is gone. lock(rid) is the store's lock.
+        with self._write_lock:
+            known = dict(self._db.execute("SELECT rid, signature FROM files"))
+        rids = {name[:-4] for name in os.listdir(self.save_dir) if name.endswith(".csv")}
+        updated = 0
+        for rid in sorted(rids):
+            with lock(rid):
+                if known.get(rid) == self._signature(rid):
+                    continue
+                try:
+                    rows, tombstones = self._read_csv(rid)
+                except FileNotFoundError:
+                    continue
+                self.replace(rid, rows, tombstones)
+                updated += 1
+        removed = [rid for rid in known if rid not in rids]
+        if removed:
+            self._drop(removed)
+        print(f"[collector] index reconciled: {updated} responses re-read, {len(removed)} removed", flush=True)
+        return updated, len(removed)
+
+    def repair(self, lock):
+        # Re-reads the responseIds whose update failed. Returns how many are
+        # still dirty.
+        with self._write_lock:
+            rids = sorted(self._dirty)
+        for rid in rids:
+            with lock(rid):
+                try:
+                    rows, tombstones = self._read_csv(rid)
+                except FileNotFoundError:
+                    self._drop([rid])
+                    continue
+                self.replace(rid, rows, tombstones)
+        with self._write_lock:
+            return len(self._dirty)
+
+    # -- queries -----------------------------------------------------------
+
+    def events(self, rid):
+        rows = self._reader().execute(
+            "SELECT ts, url, question_id, source, engine, search_results, log_id FROM events "
+            "WHERE rid = ? ORDER BY seq", (rid,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def questions(self):
+        rows = self._reader().execute(
+            "SELECT question_id, COUNT(*) AS events, COUNT(DISTINCT rid) AS responses, "
+            "SUM(engine != '') AS search_events, COUNT(DISTINCT CASE WHEN engine != '' THEN rid END) AS search_responses "
+            "FROM events GROUP BY question_id ORDER BY question_id").fetchall()
+        return [dict(row) for row in rows]
+
+    def question(self, question_id, engine=None):
+        # Per-responseId counts for one question; engine="" keeps only
+        # responses with search-engine events, engine=<name> one engine.
+        sql = ("SELECT rid, COUNT(*) AS events, SUM(engine != '') AS search_events, "
+               "GROUP_CONCAT(DISTINCT NULLIF(engine, '')) AS engines FROM events WHERE question_id = ?")
+        params = [question_id]
+        if engine:
+            sql += " AND engine = ?"
+            params.append(engine)
+        elif engine is not None:
+            sql += " AND engine != ''"
+        rows = self._reader().execute(sql + " GROUP BY rid ORDER BY rid", params).fetchall()
+        return [dict(row) for row in rows]
+
+    def sources(self, question_id=None):
+        sql = "SELECT source, engine, COUNT(*) AS events, COUNT(DISTINCT rid) AS responses FROM events"
+        params = []
+        if question_id is not None:
+            sql += " WHERE question_id = ?"
+            params.append(question_id)
+        rows = self._reader().execute(sql + " GROUP BY source, engine ORDER BY events DESC", params).fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self):
+        with self._write_lock:
+            self._db.close()
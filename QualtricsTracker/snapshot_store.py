@@ -0,0 +1,302 @@
+import csv, os, shutil, threading, time
+from collections import OrderedDict
+
+# Keeps <responseId>.csv in sync with the extension's log snapshots without
+# rewriting the whole file on every sync. Each row carries the extension's
+# log entry id; an in-memory index of those ids per responseId lets a snapshot
+# be applied as "append the new entries, tombstone the removed ones". Removed
+# rows are dropped later by a background compaction, and every full rewrite
+# goes through a temp file and os.replace so a crash never leaves a truncated CSV.
+# An optional EventIndex (event_index.py) is kept in step with every write.
+
+HEADER = ["timestamp_iso", "url", "question_id", "source", "search_results", "log_id"]
+LOG_ID_COLUMN = HEADER.index("log_id")
+
+def event_row(ev):
+    search_results = ev.get("searchResults")
+    if isinstance(search_results, list):
+        search_str = " | ".join(str(item) for item in search_results)
+    elif search_results is None:
+        search_str = ""
+    else:
+        search_str = str(search_results)
+
+    return [
+        ev.get("ts"),
+        ev.get("url"),
+        ev.get("questionId"),
+        ev.get("source"),
+        search_str,
+        ev.get("logId") or "",
+    ]
+
+class ResponseIndex:
+
+    def __init__(self):
+        self.ids = OrderedDict()     # log ids in file order
+        self.tombstones = set()      # ids removed by a snapshot, still in the file
+        self.unkeyed_rows = 0        # rows without a log id (legacy clients/files)
+        self.legacy = False          # file predates the log_id column
+        self.exists = False
+
+    def live_ids(self):
+        return [i for i in self.ids if i not in self.tombstones]
+
+class SnapshotStore:
+
+    def __init__(self, save_dir, compact_delay=2.0, max_indexes=2048, index=None):
+        self.save_dir = save_dir
+        self.index = index
+        self.compact_delay = compact_delay
+        self.max_indexes = max_indexes
+        self._indexes = OrderedDict()
+        self._locks = {}
+        self._guard = threading.Lock()
+        self._pending = {}
+        self._wakeup = threading.Condition(self._guard)
+        self._closed = False
+        self._compactor = threading.Thread(target=self._compact_loop, name="csv-compactor", daemon=True)
+        self._compactor.start()
+
+    # -- paths and locks ---------------------------------------------------
+
+    def path(self, rid):
+        return os.path.join(self.save_dir, f"{rid}.csv")
+
+    def _tomb_path(self, rid):
+        return self.path(rid) + ".tomb"
+
+    def lock(self, rid):
+        with self._guard:
+            lock = self._locks.get(rid)
+            if lock is None:
+                lock = self._locks[rid] = threading.Lock()
+            return lock
+
+    # -- index -------------------------------------------------------------
+
+    def _index(self, rid):
+        # Caller holds lock(rid).
+        with self._guard:
+            idx = self._indexes.get(rid)
+            if idx is not None:
+                self._indexes.move_to_end(rid)
+                return idx
+
+        idx = self._load_index(rid)
+        with self._guard:
+            self._indexes[rid] = idx
+            while len(self._indexes) > self.max_indexes:
+                old_rid, _ = next(iter(self._indexes.items()))
+                if old_rid in self._pending or old_rid == rid:
+                    break
+                del self._indexes[old_rid]
+        return idx
+
+    def _load_index(self, rid):
+        idx = ResponseIndex()
+        path = self.path(rid)
+        if not os.path.exists(path):
+            return idx
+        idx.exists = True
+        with open(path, newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header != HEADER:
+                # Legacy file without the log_id column.
+                idx.unkeyed_rows = sum(1 for _ in reader)
+                idx.legacy = True
+                return idx
+            for row in reader:
+                log_id = row[LOG_ID_COLUMN] if len(row) > LOG_ID_COLUMN else ""
+                if log_id:
+                    idx.ids[log_id] = None
+                else:
+                    idx.unkeyed_rows += 1
+        tomb = self._tomb_path(rid)
+        if os.path.exists(tomb):
+            with open(tomb, encoding="utf-8") as f:
+                idx.tombstones = {line.strip() for line in f if line.strip()} & idx.ids.keys()
+        return idx
+
+    # -- writes ------------------------------------------------------------
+
+    def _rewrite(self, rid, rows):
+        # Atomic full rewrite: write a temp file, fsync, then rename over the CSV.
+        path = self.path(rid)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", newline="", encoding="utf-8") as f:
+            w = csv.writer(f)
+            w.writerow(HEADER)
+            w.writerows(rows)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        try:
+            os.remove(self._tomb_path(rid))
+        except FileNotFoundError:
+            pass
+        if self.index is not None:
+            self.index.replace(rid, rows)
+
+        idx = ResponseIndex()
+        idx.exists = True
+        for row in rows:
+            if row[LOG_ID_COLUMN]:
+                idx.ids[row[LOG_ID_COLUMN]] = None
+            else:
+                idx.unkeyed_rows += 1
+        with self._guard:
+            self._indexes[rid] = idx
+            self._pending.pop(rid, None)
+        return idx
+
+    def _upgrade_legacy(self, rid):
+        # Adds the log_id column to a file written before it existed. The
+        # original is kept untouched as <rid>.csv.bak.
+        backup = self.path(rid) + ".bak"
+        if not os.path.exists(backup):
+            shutil.copy2(self.path(rid), backup + ".tmp")
+            os.replace(backup + ".tmp", backup)
+        with open(self.path(rid), newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            rows = [(row + [""] * len(HEADER))[:len(HEADER)] for row in reader]
+            for row in rows:
+                row[LOG_ID_COLUMN] = ""
+        return self._rewrite(rid, rows)
+
+    def _append_rows(self, rid, idx, rows):
+        path = self.path(rid)
+        with open(path, "a", newline="", encoding="utf-8") as f:
+            w = csv.writer(f)
+            if not idx.exists:
+                w.writerow(HEADER)
+                idx.exists = True
+            w.writerows(rows)
+        if self.index is not None:
+            self.index.add(rid, rows)
+        for row in rows:
+            if row[LOG_ID_COLUMN]:
+                idx.ids[row[LOG_ID_COLUMN]] = None
+            else:
+                idx.unkeyed_rows += 1
+
+    def append(self, rid, events):
+        # Incremental upload: append rows whose log id is not stored yet.
+        with self.lock(rid):
+            idx = self._index(rid)
+            if idx.legacy:
+                idx = self._upgrade_legacy(rid)
+            rows = []
+            seen = set()
+            for ev in events:
+                log_id = ev.get("logId")
+                if log_id and (log_id in idx.ids or log_id in seen):
+                    continue
+                if log_id:
+                    seen.add(log_id)
+                rows.append(event_row(ev))
+            if rows or not idx.exists:
+                self._append_rows(rid, idx, rows)
+            return len(rows)
+
+    def sync(self, rid, events):
+        # Applies a full snapshot of the participant's log. Returns a dict with
+        # the number of inserted and deleted rows and whether a full rewrite
+        # was needed.
+        rows = [event_row(ev) for ev in events]
+        incoming = [row[LOG_ID_COLUMN] for row in rows]
+        with self.lock(rid):
+            idx = self._index(rid)
+            live = idx.live_ids()
+            incoming_set = set(incoming)
+            survivors = [i for i in live if i in incoming_set]
+            n_new = len(incoming) - len(survivors)
+
+            needs_rewrite = (
+                idx.legacy
+                or idx.unkeyed_rows
+                or not all(incoming)
+                or len(incoming_set) != len(incoming)
+                # Surviving entries must come first, in file order, and new
+                # ones after them; anything else changes the row order.
+                or incoming[:len(survivors)] != survivors
+                or any(i in idx.ids for i in incoming[len(survivors):])
+                # Nothing survives: a header-only rewrite is cheaper.
+                or (not survivors and live)
+            )
+            if needs_rewrite:
+                self._rewrite(rid, rows)
+                return {"inserted": len(rows), "deleted": len(live), "rewritten": True}
+
+            deleted = [i for i in live if i not in incoming_set]
+            if deleted:
+                with open(self._tomb_path(rid), "a", encoding="utf-8") as f:
+                    f.write("".join(f"{i}\n" for i in deleted))
+                    f.flush()
+                    os.fsync(f.fileno())
+                idx.tombstones.update(deleted)
+                if self.index is not None:
+                    self.index.remove(rid, deleted)
+                self._schedule_compaction(rid)
+            if n_new or not idx.exists:
+                self._append_rows(rid, idx, rows[len(survivors):])
+            return {"inserted": n_new, "deleted": len(deleted), "rewritten": False}
+
+    # -- compaction --------------------------------------------------------
+
+    def _schedule_compaction(self, rid):
+        with self._wakeup:
+            self._pending.setdefault(rid, time.monotonic() + self.compact_delay)
+            self._wakeup.notify()
+
+    def compact(self, rid):
+        with self.lock(rid):
+            idx = self._index(rid)
+            if not idx.tombstones:
+                with self._guard:
+                    self._pending.pop(rid, None)
+                return 0
+            with open(self.path(rid), newline="", encoding="utf-8") as f:
+                reader = csv.reader(f)
+                next(reader, None)
+                rows = [row for row in reader
+                        if not (len(row) > LOG_ID_COLUMN and row[LOG_ID_COLUMN] in idx.tombstones)]
+            dropped = len(idx.tombstones)
+            self._rewrite(rid, rows)
+            return dropped
+
+    def _compact_loop(self):
+        while True:
+            with self._wakeup:
+                while not self._closed:
+                    now = time.monotonic()
+                    due = [rid for rid, at in self._pending.items() if at <= now]
+                    if due:
+                        break
+                    timeout = min(self._pending.values()) - now if self._pending else None
+                    self._wakeup.wait(timeout)
+                if self._closed:
+                    return
+            for rid in due:
+                try:
+                    dropped = self.compact(rid)
+                    print(f"[collector] compacted {rid}: dropped {dropped} removed rows", flush=True)
+                except OSError as e:
+                    print(f"[collector] compaction failed for {rid}: {e}", flush=True)
+                    with self._wakeup:
+                        self._pending[rid] = time.monotonic() + self.compact_delay
+
+    def close(self):
+        # Stops the background thread and compacts whatever is still pending.
+        with self._wakeup:
+            self._closed = True
+            pending = list(self._pending)
+            self._wakeup.notify()
+        self._compactor.join(timeout=5)
+        for rid in pending:
+            try:
+                self.compact(rid)
+            except OSError as e:
+                print(f"[collector] compaction failed for {rid}: {e}", flush=True)
@@ -1,60 +1,310 @@
+import time
+IMPORT_STARTED = time.perf_counter()
+
 import os
 import gradio as gr
-from openai import AsyncOpenAI
-import asyncio
+from openai import APIStatusError, APIConnectionError
+import asyncio, contextlib
+import signal, uuid
+from fastapi import Response
 
 from logger import log_event
-from chat_helpers import build_input_from_history, build_init_history
+from chat_helpers import build_input_from_history, count_text_tokens, get_scenario_registry
+from metrics import Counter, Gauge, Histogram, start_http_server, METRICS_PORT
+from upstream import (Scheduler, QueueFull, ConnectionWarmer, UPSTREAM_MAX_INFLIGHT, UPSTREAM_MAX_QUEUE,
+                      UPSTREAM_PREWARM, make_client, retry_delay)
+import sessions
+import response_cache
+from tasks import supervisor, TASK_DRAIN_TIMEOUT
+from warmup import readiness, use_tiktoken_cache, warm_local, warm_upstream
+
+use_tiktoken_cache()
+
+oclient = make_client()
+scheduler = Scheduler()
+warmer = ConnectionWarmer(oclient, scheduler)
+
+# The scheduler does admission control, so Gradio only needs enough workers
+# to hold every admitted and queued stream.
+GRADIO_CONCURRENCY = int(os.getenv("GRADIO_CONCURRENCY", str(UPSTREAM_MAX_INFLIGHT + UPSTREAM_MAX_QUEUE)))
+
+# Workers started by serve.py sit behind its proxy and do not open share links.
+APP_SHARE = os.getenv("APP_SHARE", "1") == "1"
+
+STREAM_FRAME_MS = float(os.getenv("STREAM_FRAME_MS", "50"))
+STREAM_FRAME_CHARS = int(os.getenv("STREAM_FRAME_CHARS", "256"))
+
+TTFT_SECONDS = Histogram("chat_time_to_first_token_seconds", "Time from respond() start to the first streamed frame.")
+STREAM_SECONDS = Histogram("chat_stream_seconds", "Full duration of respond() streams.",
+                           buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0))
+STREAMS_IN_FLIGHT = Gauge("chat_streams_in_flight", "Upstream streams currently open.")
+UPSTREAM_ERRORS = Counter("upstream_errors_total", "Upstream API errors by exception type.", ["error"])
+TURNS_CANCELLED = Counter("chat_turns_cancelled_total", "Chat turns cancelled before finishing.", ["reason"])
+CANCELLED_TOKENS = Counter("chat_cancelled_tokens_total",
+                           "Estimated tokens spent on cancelled turns (input sent, output streamed before the cancel).",
+                           ["reason", "kind"])
+UPSTREAM_QUEUE_DEPTH = Gauge("upstream_queue_depth", "Turns waiting for an upstream slot.",
+                             fn=lambda: scheduler.stats()["queue_depth"])
+
+WAITING_MESSAGE = "_Waiting for a free slot (position {position} in line)…_"
+SESSION_RESEEDED_NOTICE = ("Your earlier conversation could not be restored, so the assistant will not remember it. "
+                           "Please repeat anything it needs to know.")
+
+async def _frames(stream, frame_ms, frame_chars):
+    # Deltas are coalesced into frames: a frame is emitted once frame_chars
+    # have accumulated, frame_ms has passed since the last frame, or a
+    # non-text event (e.g. a web search) interrupts the text.
+    text = ""
+    pending = []
+    pending_chars = 0
+    last_frame = time.monotonic()
+    async for event in stream:
+        if event.type == "response.output_text.delta":
+            pending.append(event.delta)
+            pending_chars += len(event.delta)
+            now = time.monotonic()
+            if pending_chars < frame_chars and (now - last_frame) * 1000 < frame_ms:
+                continue
+        elif not pending:
+            continue
+        text += "".join(pending)
+        pending.clear()
+        pending_chars = 0
+        last_frame = time.monotonic()
+        yield text
 
-oclient = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    if pending:
+        text += "".join(pending)
+        yield text
 
-async def respond(message, history):
-    text_input = build_input_from_history(message, history)
-    kwargs = dict(
+def build_request(message, history, token_counts=None, prefix=None):
+    return dict(
         model="gpt-4.1",
-        input=text_input,
+        input=build_input_from_history(message, history, token_counts, prefix),
         temperature=0,
         tools=[{"type": "web_search"}],
         tool_choice="auto",
         parallel_tool_calls=True,
     )
 
-    buffer = []
-    async with oclient.responses.stream(**kwargs) as stream:
-        async for event in stream:
-            if event.type == "response.output_text.delta":
-                buffer.append(event.delta)
-                yield "".join(buffer)
+async def respond(message, history, frame_ms=STREAM_FRAME_MS, frame_chars=STREAM_FRAME_CHARS, token_counts=None,
+                  request=None):
+    kwargs = request if request is not None else build_request(message, history, token_counts)
+
+    started = time.perf_counter()
+    STREAMS_IN_FLIGHT.inc()
+    try:
+        attempt = 0
+        first_frame = True
+        while True:
+            text = ""
+            try:
+                async with oclient.responses.stream(**kwargs) as stream:
+                    async for text in _frames(stream, frame_ms, frame_chars):
+                        if first_frame:
+                            first_frame = False
+                            TTFT_SECONDS.observe(time.perf_counter() - started)
+                        yield text
+                    final = await stream.get_final_response()
+                break
+            except (APIStatusError, APIConnectionError) as e:
+                UPSTREAM_ERRORS.inc(error=e.__class__.__name__)
+                # Only retry while nothing has been shown to the participant.
+                delay = None if text else retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                scheduler.record_retry()
+                print(f"[app] upstream error ({e.__class__.__name__}), retry {attempt} in {delay:.1f}s", flush=True)
+                await asyncio.sleep(delay)
 
-        final = await stream.get_final_response()
         final_text = getattr(final, "output_text", None)
-        if final_text and (not buffer or final_text != "".join(buffer)):
+        if final_text and final_text != text:
             yield final_text
+    finally:
+        STREAMS_IN_FLIGHT.dec()
+        STREAM_SECONDS.observe(time.perf_counter() - started)
 
 async def init_from_request(request: gr.Request):
 
     pid, q, ant, correct = get_params_from_request(request)
 
     ant_flag = (ant == "1")
-    history = build_init_history(q, ant_flag, correct)
-    asyncio.create_task(log_event(pid, "session_start", {"q": q, "ant": ant_flag, "correct": correct}))
+    # The session holds the scenario's input prefix and token counts, so the
+    # first turn only adds the participant's message. With UPSTREAM_PREWARM,
+    # an upstream connection is opened while they read the seeded conversation.
+    session = _new_session(getattr(request, "session_hash", None), pid, q, ant, correct)
+    if UPSTREAM_PREWARM:
+        if warmer.expect(session.key):
+            supervisor.spawn(warmer.warm(), name="prewarm", bounded=False)
+    supervisor.spawn(log_event(pid, "session_start", {"q": q, "ant": ant_flag, "correct": correct}), name="log_event")
+
+    return pid, q, ant, correct, session.key, session.visible_messages()
+
+def _new_session(key, pid, q, ant, correct):
+    scenario = get_scenario_registry().get(q, ant == "1", correct == "1")
+    return sessions.store.create(key or uuid.uuid4().hex, pid, q, ant, correct,
+                                 scenario.history(), scenario.token_counts)
+
+_DONE = object()
+
+class Turn:
+    # One chat turn (waiting for a slot, then streaming) runs in its own
+    # supervised task and hands frames to the Gradio event through a queue,
+    # so it can be cancelled when the participant sends again or leaves
+    # without waiting for Gradio to stop iterating.
+
+    def __init__(self, session, message, ticket, request, cache_key=None, cached=None):
+        # ticket is None for a cache hit, which needs no upstream slot.
+        self.session = session
+        self.message = message
+        self.ticket = ticket
+        self.request = request
+        self.cache_key = cache_key
+        self.cached = cached
+        self.text = ""
+        self.streaming = False
+        self.cancel_reason = None
+        self.task = None
+        self._queue = asyncio.Queue()
+
+    def start(self):
+        self.task = supervisor.spawn(self._run(), name="chat_turn", bounded=False)
 
-    return pid, q, ant, correct, history
+    def cancel(self, reason):
+        if self.task is not None and not self.task.done() and self.cancel_reason is None:
+            self.cancel_reason = reason
+            self.task.cancel()
 
-async def chat_driver(user_message, messages_history, _pid, _q, _ant, _correct):
-    messages_history = messages_history or []
-    base = messages_history + [{"role": "user", "content": user_message}]
-    assistant_text = ""
+    async def finished(self):
+        if self.task is not None:
+            await asyncio.wait([self.task])
 
-    asyncio.create_task(log_event(_pid, "chat_user",
-                                 {"text": user_message, "q": _q, "ant": _ant, "correct": _correct}))
+    async def frames(self):
+        # Frames are cumulative, so a consumer that falls behind only gets
+        # the latest one.
+        while True:
+            item = await self._queue.get()
+            done = item is _DONE
+            while not done and not self._queue.empty():
+                latest = self._queue.get_nowait()
+                if latest is _DONE:
+                    done = True
+                else:
+                    item = latest
+            if item is not _DONE:
+                yield item
+            if done:
+                return
 
-    async for chunk in respond(user_message, messages_history):
-        assistant_text = chunk
-        yield base + [{"role": "assistant", "content": assistant_text}], ""
+    async def _run(self):
+        try:
+            if self.cached is not None:
+                # Same framing as a live stream.
+                events = response_cache.replay_events(self.cached)
+                async for chunk in _frames(events, STREAM_FRAME_MS, STREAM_FRAME_CHARS):
+                    self.text = chunk
+                    self._queue.put_nowait(chunk)
+                return
+            async for position in self.ticket.wait():
+                self._queue.put_nowait(WAITING_MESSAGE.format(position=position))
+            self.streaming = True
+            async for chunk in respond(self.message, self.session.messages, request=self.request):
+                self.text = chunk
+                self._queue.put_nowait(chunk)
+            if self.cache_key is not None:
+                await response_cache.cache.put(self.cache_key, self.text)
+        except asyncio.CancelledError:
+            # Cancelled by the supervisor at shutdown if no reason was given.
+            self.cancel_reason = self.cancel_reason or "shutdown"
+        finally:
+            try:
+                if self.ticket is not None:
+                    self.ticket.release()
+                self._finish()
+            finally:
+                self._queue.put_nowait(_DONE)
 
-    asyncio.create_task(log_event(_pid, "chat_assistant",
-                                 {"text": assistant_text, "q": _q, "ant": _ant, "correct": _correct}))
+    def _finish(self):
+        s = self.session
+        if s.turn is self:
+            s.turn = None
+        reply_tokens = count_text_tokens(self.text) if self.text else 0
+        sessions.store.append(s, "user", self.message, count_text_tokens(self.message))
+        if self.text:
+            sessions.store.append(s, "assistant", self.text, reply_tokens)
+
+        payload = {"text": self.text, "q": s.q, "ant": s.ant, "correct": s.correct}
+        if self.cache_key is not None:
+            payload.update(cache="hit" if self.cached is not None else "miss", cache_key=self.cache_key[:16])
+        if self.cancel_reason is not None:
+            reason = self.cancel_reason
+            TURNS_CANCELLED.inc(reason=reason)
+            # The input as sent upstream: truncated, with the new message.
+            input_tokens = sum(count_text_tokens(p["content"]) for p in self.request["input"]) if self.streaming else 0
+            if self.streaming:
+                CANCELLED_TOKENS.inc(input_tokens, reason=reason, kind="input")
+                CANCELLED_TOKENS.inc(reply_tokens, reason=reason, kind="output")
+            payload.update(cancelled=reason, wasted_tokens={"input": input_tokens,
+                                                            "output": reply_tokens})
+            print(f"[app] turn for {s.pid} cancelled ({reason}) after {reply_tokens} output tokens", flush=True)
+        supervisor.spawn(log_event(s.pid, "chat_assistant", payload), name="log_event")
+
+async def chat_driver(user_message, session_key, _pid, _q, _ant, _correct):
+    # The history lives server-side; the browser only sends the new message.
+    session = sessions.store.get(session_key)
+    if session is None:
+        # Evicted (or the server restarted): start again from the scenario.
+        # The model no longer sees the earlier turns, so record it and tell
+        # the participant.
+        print(f"[app] session {session_key!r} for {_pid} not found, reseeding", flush=True)
+        session = _new_session(session_key, _pid, _q, _ant, _correct)
+        supervisor.spawn(log_event(_pid, "session_reseeded", {"q": _q, "ant": _ant, "correct": _correct}),
+                         name="log_event")
+        gr.Warning(SESSION_RESEEDED_NOTICE)
+
+    # A new message supersedes a turn that is still waiting or streaming.
+    previous = session.turn
+    if previous is not None:
+        previous.cancel("superseded")
+        await previous.finished()
+
+    warmer.forget(session.key)
+    request = build_request(user_message, session.messages, session.token_counts, session.prefix)
+    key = cached = ticket = None
+    if response_cache.cache is not None and response_cache.cacheable(request):
+        key = response_cache.cache_key(request)
+        cached = await response_cache.cache.get(key)
+
+    # Logged before admission, so messages rejected below are recorded too.
+    supervisor.spawn(log_event(_pid, "chat_user",
+                               {"text": user_message, "q": _q, "ant": _ant, "correct": _correct}), name="log_event")
+
+    if cached is None:
+        try:
+            ticket = scheduler.ticket(_pid)
+        except QueueFull:
+            raise gr.Error("The assistant is busy right now. Please send your message again in a moment.")
+
+    reply = {"role": "assistant", "content": ""}
+    transcript = session.visible_messages() + [{"role": "user", "content": user_message}, reply]
+    turn = session.turn = Turn(session, user_message, ticket, request, key, cached)
+    turn.start()
+    try:
+        async for frame in turn.frames():
+            reply["content"] = frame
+            yield transcript, ""
+        # Surfaces upstream errors; a cancelled turn just ends.
+        await turn.task
+    finally:
+        # The Gradio event was cancelled or closed (e.g. the tab went away).
+        turn.cancel("disconnect")
+
+def end_session(request: gr.Request):
+    session = sessions.store.drop(getattr(request, "session_hash", None))
+    warmer.forget(getattr(request, "session_hash", None))
+    if session is not None and session.turn is not None:
+        session.turn.cancel("disconnect")
 
 def get_params_from_request(request: gr.Request):
     try:
@@ -77,6 +327,7 @@ with gr.Blocks(title="Search Bot", theme="soft") as demo:
     q_state   = gr.State("")
     ant_state = gr.State("")
     correct_state = gr.State("")
+    session_state = gr.State("")
 
     with gr.Column(visible=True) as app_view:
 
@@ -94,21 +345,58 @@ with gr.Blocks(title="Search Bot", theme="soft") as demo:
         demo.load(
             fn=init_from_request,
             inputs=[],
-            outputs=[pid_state, q_state, ant_state, correct_state, chatbot],
+            outputs=[pid_state, q_state, ant_state, correct_state, session_state, chatbot],
         )
 
         ev = send_btn.click(
             chat_driver,
-            inputs=[chat_input, chatbot, pid_state, q_state, ant_state, correct_state],
+            inputs=[chat_input, session_state, pid_state, q_state, ant_state, correct_state],
             outputs=[chatbot, chat_input]
         )
 
         ev2 = chat_input.submit(
             chat_driver,
-            inputs=[chat_input, chatbot, pid_state, q_state, ant_state, correct_state],
+            inputs=[chat_input, session_state, pid_state, q_state, ant_state, correct_state],
             outputs=[chatbot, chat_input]
         )
 
+        demo.unload(end_session)
+
+
+demo.queue(default_concurrency_limit=GRADIO_CONCURRENCY)
+
+def ready():
+    status, content_type, body = readiness.response()
+    return Response(body, status_code=status, media_type=content_type)
+
+@contextlib.asynccontextmanager
+async def lifespan(fastapi_app):
+    # Runs on the server's event loop, which owns the upstream connection pool.
+    fastapi_app.add_api_route("/ready", ready, methods=["GET"])
+    supervisor.spawn(warm_upstream(oclient), name="warm_upstream", bounded=False)
+    yield
+
+import_seconds = time.perf_counter() - IMPORT_STARTED
+IMPORT_SECONDS = Gauge("app_import_seconds", "Time taken to import app.py.")
+IMPORT_SECONDS.set(import_seconds)
 
 if __name__ == "__main__":
-    demo.launch(share=True)
+    print(f"[app] imported in {import_seconds:.2f}s", flush=True)
+    warm_local()
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT, routes={"/ready": readiness.response})
+    def _on_sigterm(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, _on_sigterm)
+    demo.launch(share=APP_SHARE, prevent_thread_lock=True, app_kwargs={"lifespan": lifespan})
+    try:
+        while True:
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        print("[app] shutting down, draining background tasks", flush=True)
+    finally:
+        # Let in-flight turns and log writes finish (or cancel them after
+        # TASK_DRAIN_TIMEOUT) before the server and its event loop go away.
+        supervisor.drain_threadsafe(TASK_DRAIN_TIMEOUT)
+        demo.close()
@@ -0,0 +1,276 @@
+import os
+import argparse, asyncio, datetime, gc, itertools, json, pathlib, platform, subprocess
+import sys, tempfile, time, tracemalloc, types
+
+from bench.mock_upstream import MockServer, add_mock_args, config_from_args
+
+# Drives N simulated participants through init_from_request and multi-turn
+# chat_driver calls against the mock upstream, and saves the measurements as
+# JSON so runs can be compared across commits:
+#
+#   python -m bench.loadgen --participants 50 --turns 3 --out bench/results/run.json
+#
+# The handlers run in this process, so Gradio's queue, SSE streaming and HTTP
+# handling are not part of the measurements; see the README.
+
+RESULTS_DIR = pathlib.Path(__file__).parent / "results"
+CONDITIONS = [(q, ant, cor) for q in ("Q0", "Q1", "Q2", "Q3", "Q4", "Q5", "Q6")
+              for ant in ("0", "1") for cor in ("0", "1")]
+FOLLOW_UPS = ("Are you sure?", "What's your source?", "Can you double check that?",
+              "Why do you think so?", "Is there another answer?")
+
+def percentiles(values, points=(50, 95, 99)):
+    if not values:
+        return {**{f"p{p}": None for p in points}, "mean": None, "max": None, "n": 0}
+    ordered = sorted(values)
+    out = {}
+    for p in points:
+        rank = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))
+        out[f"p{p}"] = ordered[rank]
+    out["mean"] = sum(ordered) / len(ordered)
+    out["max"] = ordered[-1]
+    out["n"] = len(ordered)
+    return out
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def fake_request(pid, q, ant, cor):
+    return types.SimpleNamespace(query_params={"pid": pid, "q": q, "ant": ant, "cor": cor})
+
+class LoopLagMonitor:
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+class TurnRecorder:
+
+    def __init__(self, waiting_prefix):
+        self.waiting_prefix = waiting_prefix
+        self.turns = []
+        self.inits = []
+        self.errors = []
+
+    async def turn(self, app, message, session_key, pid, q, ant, cor, condition=None, first_turn=False):
+        # Returns the transcript after the turn, or None if the turn failed.
+        start = time.perf_counter()
+        first = None
+        frames = 0
+        transcript = None
+        try:
+            async for transcript, _ in app.chat_driver(message, session_key, pid, q, ant, cor):
+                content = transcript[-1]["content"]
+                if content.startswith(self.waiting_prefix):
+                    continue
+                frames += 1
+                if first is None:
+                    first = time.perf_counter()
+        except Exception as e:
+            self.errors.append({"pid": pid, "error": f"{e.__class__.__name__}: {e}"})
+            return None
+        end = time.perf_counter()
+        chars = len(transcript[-1]["content"]) if transcript else 0
+        streaming = end - first if first is not None else 0.0
+        self.turns.append({
+            "condition": condition or f"{q}/ant={ant}/cor={cor}",
+            "first_turn": first_turn,
+            "ttft": first - start if first is not None else None,
+            "duration": end - start,
+            "frames": frames,
+            "chars": chars,
+            "chars_per_sec": chars / streaming if streaming > 0 else None,
+        })
+        return transcript
+
+    def summary(self):
+        ttft = [t["ttft"] for t in self.turns if t["ttft"] is not None]
+        return {
+            "turns": len(self.turns),
+            "errors": len(self.errors),
+            "error_samples": self.errors[:10],
+            "init_seconds": percentiles(self.inits),
+            "ttft_seconds": percentiles(ttft),
+            "first_turn_ttft_seconds": percentiles([t["ttft"] for t in self.turns
+                                                    if t["first_turn"] and t["ttft"] is not None]),
+            "stream_seconds": percentiles([t["duration"] for t in self.turns]),
+            "chars_per_sec": percentiles([t["chars_per_sec"] for t in self.turns if t["chars_per_sec"]]),
+            "frames_per_turn": percentiles([t["frames"] for t in self.turns]),
+        }
+
+async def participant(app, recorder, index, condition, turns, think_s, start_delay, read_s=0.0):
+    await asyncio.sleep(start_delay)
+    q, ant, cor = condition
+    pid = f"bench_{index:05d}"
+    t0 = time.perf_counter()
+    _, _, _, _, session_key, history = await app.init_from_request(fake_request(pid, q, ant, cor))
+    recorder.inits.append(time.perf_counter() - t0)
+    for turn in range(turns):
+        # read_s: time spent reading the seeded conversation before typing.
+        pause = think_s if turn else read_s
+        if pause:
+            await asyncio.sleep(pause)
+        message = FOLLOW_UPS[(index + turn) % len(FOLLOW_UPS)]
+        transcript = await recorder.turn(app, message, session_key, pid, q, ant, cor, first_turn=turn == 0)
+        if transcript is None:
+            break
+        history = transcript
+    return history
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+async def run(app, participants, turns, think_s, ramp_s, warmup=1, trace_memory=False, read_s=0.0):
+    from logger import flush_logs
+
+    waiting_prefix = app.WAITING_MESSAGE.split("{")[0]
+    # Warm-up turns pay for lazy imports and the first connection; they are
+    # not part of the measured run.
+    for i in range(warmup):
+        await participant(app, TurnRecorder(waiting_prefix), 90000 + i, CONDITIONS[i % len(CONDITIONS)], 1, 0, 0)
+
+    recorder = TurnRecorder(waiting_prefix)
+    monitor = LoopLagMonitor()
+
+    gc.collect()
+    # tracemalloc is exact but slows the loop down a lot, so it is opt-in;
+    # the default is the RSS growth over the run.
+    if trace_memory:
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+    else:
+        baseline = rss_bytes()
+    monitor.start()
+    started = time.perf_counter()
+    conditions = itertools.cycle(CONDITIONS)
+    histories = await asyncio.gather(*[
+        participant(app, recorder, i, next(conditions), turns, think_s,
+                    ramp_s * i / participants if participants else 0, read_s)
+        for i in range(participants)
+    ])
+    wall = time.perf_counter() - started
+    await monitor.stop()
+    await flush_logs()
+    if trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        memory = {"method": "tracemalloc", "retained": current - baseline, "peak": peak - baseline}
+    else:
+        rss = rss_bytes()
+        memory = {"method": "rss", "retained": rss - baseline if rss and baseline else None, "peak": None}
+    del histories
+
+    def per_session(value):
+        return value / participants if participants and value is not None else None
+
+    summary = recorder.summary()
+    summary.update({
+        "wall_seconds": wall,
+        "turns_per_sec": summary["turns"] / wall if wall else None,
+        "loop_lag_seconds": percentiles(monitor.samples),
+        "memory_method": memory["method"],
+        "memory_bytes_per_session": per_session(memory["retained"]),
+        "peak_memory_bytes_per_session": per_session(memory["peak"]),
+    })
+    return summary
+
+def prepare_environment(args, base_url):
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    if args.data_dir:
+        os.environ["APP_DATA_DIR"] = args.data_dir
+    else:
+        os.environ.setdefault("APP_DATA_DIR", tempfile.mkdtemp(prefix="bench_user_data_"))
+
+def save(result, out):
+    if out is None:
+        stamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+        out = RESULTS_DIR / f"{result['meta']['name']}-{result['meta']['commit'] or 'nocommit'}-{stamp}.json"
+    out = pathlib.Path(out)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(result, indent=2))
+    return out
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load benchmark for respond/chat_driver against a mock upstream.")
+    parser.add_argument("--participants", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--think-ms", type=float, default=0.0)
+    parser.add_argument("--ramp-s", type=float, default=0.0)
+    parser.add_argument("--read-ms", type=float, default=0.0, help="pause between session start and the first message")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed warm-up turns before the run")
+    parser.add_argument("--trace-memory", action="store_true", help="measure memory with tracemalloc")
+    parser.add_argument("--upstream-url", default=None,
+                        help="use an already running mock (or real endpoint) instead of starting one")
+    parser.add_argument("--data-dir", default=None, help="APP_DATA_DIR for the run (default: a temp dir)")
+    parser.add_argument("--out", default=None)
+    add_mock_args(parser)
+    args = parser.parse_args(argv)
+
+    mock = None
+    if args.upstream_url is None:
+        mock = MockServer(config_from_args(args)).start()
+    prepare_environment(args, args.upstream_url or mock.base_url)
+
+    t0 = time.perf_counter()
+    import app
+    import_seconds = time.perf_counter() - t0
+
+    try:
+        results = asyncio.run(run(app, args.participants, args.turns, args.think_ms / 1000, args.ramp_s,
+                                  warmup=args.warmup, trace_memory=args.trace_memory, read_s=args.read_ms / 1000))
+    finally:
+        if mock is not None:
+            mock.stop()
+
+    results["app_import_seconds"] = import_seconds
+    results["scheduler"] = app.scheduler.stats()
+    results["sessions"] = app.sessions.store.stats()
+    if mock is not None:
+        results["upstream"] = dict(mock.stats)
+    result = {
+        "meta": {
+            "name": "loadgen",
+            "commit": git_commit(),
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    out = save(result, args.out)
+    r = results
+    print(f"[bench] {r['turns']} turns, {r['errors']} errors in {r['wall_seconds']:.1f}s; "
+          f"ttft p50={r['ttft_seconds']['p50']} p95={r['ttft_seconds']['p95']} p99={r['ttft_seconds']['p99']}; "
+          f"first turn p50={r['first_turn_ttft_seconds']['p50']}", flush=True)
+    print(f"[bench] results written to {out}", flush=True)
+
+if __name__ == "__main__":
+    main()
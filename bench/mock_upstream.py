@@ -0,0 +1,217 @@
+import os
+import argparse, asyncio, itertools, json, random, threading, time, uuid
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+# A local stand-in for the OpenAI Responses API. It speaks the same SSE event
+# protocol as POST /v1/responses with stream=true, so AsyncOpenAI pointed at
+# it (base_url=http://127.0.0.1:<port>/v1) drives respond() unchanged.
+
+WORDS = ("the", "answer", "is", "based", "on", "recent", "reporting", "and", "several",
+         "sources", "agree", "that", "this", "figure", "remains", "the", "highest", "recorded")
+
+class MockConfig:
+
+    def __init__(self, tokens_per_sec=80.0, ttft_ms=400.0, jitter=0.2, response_tokens=120,
+                 error_rate=0.0, error_status=429, retry_after=None, seed=None, connect_ms=0.0):
+        self.tokens_per_sec = tokens_per_sec
+        self.ttft_ms = ttft_ms
+        self.jitter = jitter
+        self.response_tokens = response_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        # Added to the first request on each client connection, standing in
+        # for the TCP and TLS handshakes a real upstream costs.
+        self.connect_ms = connect_ms
+        self.rng = random.Random(seed)
+
+    def as_dict(self):
+        return {k: v for k, v in vars(self).items() if k != "rng"}
+
+def _jittered(cfg, seconds):
+    if not cfg.jitter:
+        return seconds
+    return max(0.0, seconds * cfg.rng.uniform(1 - cfg.jitter, 1 + cfg.jitter))
+
+def _sse(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+def _response(rid, model, status, output, created_at, body):
+    return {
+        "id": rid,
+        "object": "response",
+        "created_at": created_at,
+        "status": status,
+        "model": model,
+        "output": output,
+        "parallel_tool_calls": body.get("parallel_tool_calls", True),
+        "temperature": body.get("temperature"),
+        "tool_choice": body.get("tool_choice", "auto"),
+        "tools": body.get("tools", []),
+        "top_p": 1.0,
+        "error": None,
+        "incomplete_details": None,
+        "instructions": None,
+        "metadata": {},
+    }
+
+async def _stream(cfg, body, stats):
+    rid = f"resp_{uuid.uuid4().hex}"
+    mid = f"msg_{uuid.uuid4().hex}"
+    model = body.get("model", "gpt-4.1")
+    created_at = int(time.time())
+    seq = itertools.count()
+    words = [cfg.rng.choice(WORDS) for _ in range(cfg.response_tokens)]
+    deltas = [w + " " for w in words[:-1]] + [words[-1] + "."] if words else []
+    text = "".join(deltas)
+
+    def ev(**fields):
+        return _sse({**fields, "sequence_number": next(seq)})
+
+    stats["streams"] += 1
+    stats["active"] += 1
+    try:
+        yield ev(type="response.created", response=_response(rid, model, "in_progress", [], created_at, body))
+        yield ev(type="response.in_progress", response=_response(rid, model, "in_progress", [], created_at, body))
+        await asyncio.sleep(_jittered(cfg, cfg.ttft_ms / 1000))
+
+        item = {"id": mid, "type": "message", "role": "assistant", "status": "in_progress", "content": []}
+        yield ev(type="response.output_item.added", output_index=0, item=item)
+        yield ev(type="response.content_part.added", item_id=mid, output_index=0, content_index=0,
+                 part={"type": "output_text", "text": "", "annotations": []})
+
+        interval = 1 / cfg.tokens_per_sec if cfg.tokens_per_sec > 0 else 0
+        for delta in deltas:
+            yield ev(type="response.output_text.delta", item_id=mid, output_index=0, content_index=0,
+                     delta=delta, logprobs=[])
+            stats["tokens"] += 1
+            if interval:
+                await asyncio.sleep(_jittered(cfg, interval))
+
+        part = {"type": "output_text", "text": text, "annotations": []}
+        yield ev(type="response.output_text.done", item_id=mid, output_index=0, content_index=0,
+                 text=text, logprobs=[])
+        yield ev(type="response.content_part.done", item_id=mid, output_index=0, content_index=0, part=part)
+        done_item = {**item, "status": "completed", "content": [part]}
+        yield ev(type="response.output_item.done", output_index=0, item=done_item)
+        yield ev(type="response.completed",
+                 response=_response(rid, model, "completed", [done_item], created_at, body))
+    except asyncio.CancelledError:
+        stats["cancelled"] += 1
+        raise
+    finally:
+        stats["active"] -= 1
+
+class ConnectDelay:
+    # ASGI middleware: delays the first request seen from each client address.
+
+    def __init__(self, app, cfg, stats):
+        self.app = app
+        self.cfg = cfg
+        self.stats = stats
+        self._seen = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope.get("client"):
+            client = tuple(scope["client"])
+            if client not in self._seen:
+                self._seen.add(client)
+                self.stats["connections"] += 1
+                if self.cfg.connect_ms:
+                    await asyncio.sleep(self.cfg.connect_ms / 1000)
+        await self.app(scope, receive, send)
+
+def create_app(cfg: MockConfig):
+    stats = {"requests": 0, "streams": 0, "errors": 0, "cancelled": 0, "tokens": 0, "active": 0, "connections": 0}
+
+    async def responses(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        if cfg.error_rate and cfg.rng.random() < cfg.error_rate:
+            stats["errors"] += 1
+            headers = {}
+            if cfg.retry_after is not None:
+                headers["retry-after"] = str(cfg.retry_after)
+            message = {"error": {"message": "injected error", "type": "mock_error", "code": cfg.error_status}}
+            return JSONResponse(message, status_code=cfg.error_status, headers=headers)
+        if not body.get("stream"):
+            return JSONResponse({"error": {"message": "mock only supports stream=true"}}, status_code=400)
+        return StreamingResponse(_stream(cfg, body, stats), media_type="text/event-stream")
+
+    async def stats_view(request: Request):
+        return JSONResponse({**stats, "config": cfg.as_dict()})
+
+    app = Starlette(routes=[
+        Route("/v1/responses", responses, methods=["POST"]),
+        Route("/stats", stats_view),
+    ], middleware=[Middleware(ConnectDelay, cfg=cfg, stats=stats)])
+    app.state.stats = stats
+    return app
+
+class MockServer:
+    # Runs the mock in a background thread so a benchmark can share the process.
+
+    def __init__(self, cfg: MockConfig, host="127.0.0.1", port=0):
+        self.app = create_app(cfg)
+        self.server = uvicorn.Server(uvicorn.Config(self.app, host=host, port=port, log_level="warning"))
+        self._thread = threading.Thread(target=self.server.run, name="mock-upstream", daemon=True)
+
+    @property
+    def stats(self):
+        return self.app.state.stats
+
+    @property
+    def base_url(self):
+        sock = self.server.servers[0].sockets[0]
+        host, port = sock.getsockname()[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def stop(self):
+        self.server.should_exit = True
+        self._thread.join(timeout=5)
+
+def add_mock_args(parser):
+    parser.add_argument("--tokens-per-sec", type=float, default=80.0)
+    parser.add_argument("--ttft-ms", type=float, default=400.0)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--response-tokens", type=int, default=120)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument("--retry-after", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--connect-ms", type=float, default=0.0,
+                        help="extra delay on the first request of each connection (handshake cost)")
+
+def config_from_args(args):
+    return MockConfig(
+        tokens_per_sec=args.tokens_per_sec,
+        ttft_ms=args.ttft_ms,
+        jitter=args.jitter,
+        response_tokens=args.response_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after,
+        seed=args.seed,
+        connect_ms=args.connect_ms,
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline mock of the OpenAI Responses streaming API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(os.getenv("MOCK_UPSTREAM_PORT", "8099")))
+    add_mock_args(parser)
+    args = parser.parse_args()
+    print(f"[mock] serving on http://{args.host}:{args.port}/v1", flush=True)
+    uvicorn.run(create_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning")
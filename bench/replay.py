@@ -0,0 +1,285 @@
+import os
+import argparse, asyncio, datetime, json, platform, statistics, sys, time
+from dataclasses import dataclass, field
+
+from bench.loadgen import (LoopLagMonitor, TurnRecorder, fake_request, git_commit, percentiles,
+                           prepare_environment, save)
+from bench.mock_upstream import MockServer, add_mock_args, config_from_args
+from log_segments import chat_log_files
+
+# Replays recorded sessions from the chat logs (session_start / chat_user /
+# chat_assistant events) through init_from_request and chat_driver against
+# the mock upstream. Arrival times, think times between turns, the messages
+# and the condition mix all come from the recordings:
+#
+#   python -m bench.replay --trace-dir user_data --speed 10
+#   python -m bench.replay --trace-dir user_data --speed max --search 10,25,50,100,200
+#
+# --search replays N concurrent sessions (drawn from the trace in order) for
+# each level and reports the first level that breaks the SLOs.
+#
+# Limitation: app.py is imported and its handlers are called in process, so
+# Gradio's queue, SSE streaming and HTTP handling are not measured, nor is
+# GRADIO_CONCURRENCY. The SLO levels found here are an upper bound for the
+# served app; confirm them against a running server before relying on them.
+
+@dataclass
+class RecordedSession:
+    pid: str
+    q: str
+    ant: str
+    cor: str
+    start: float                                # seconds after the first recorded session
+    turns: list = field(default_factory=list)   # (think seconds, message)
+    reply_words: list = field(default_factory=list)
+
+    @property
+    def condition(self):
+        return f"{self.q}/ant={self.ant}/cor={self.cor}"
+
+def _flag(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return str(value or "")
+
+def _ts(value):
+    value = str(value or "")
+    if value.endswith("+00:00Z"):
+        value = value[:-1]
+    try:
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+def _trace_records(trace_dir):
+    for path, skip in chat_log_files(trace_dir):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(rec, dict) or (skip is not None and skip(rec)):
+                    continue
+                if rec.get("kind") in ("session_start", "chat_user", "chat_assistant"):
+                    yield rec
+
+def load_sessions(trace_dir):
+    # Every session_start opens a new session for its pid; think time is the
+    # gap between the previous reply (or the session start) and the next
+    # message.
+    by_pid = {}
+    for rec in _trace_records(trace_dir):
+        ts = _ts(rec.get("ts"))
+        if ts is not None:
+            by_pid.setdefault(rec.get("pid") or "anon", []).append((ts, rec))
+
+    sessions = []
+    for pid, records in by_pid.items():
+        records.sort(key=lambda item: item[0])
+        current, last = None, None
+        for ts, rec in records:
+            if rec["kind"] == "session_start":
+                current = RecordedSession(pid, rec.get("q") or "", _flag(rec.get("ant")),
+                                          _flag(rec.get("correct")), ts)
+                sessions.append(current)
+                last = ts
+            elif current is None:
+                continue
+            elif rec["kind"] == "chat_user":
+                current.turns.append((max(0.0, ts - last), rec.get("text") or ""))
+                last = ts
+            else:
+                current.reply_words.append(len((rec.get("text") or "").split()))
+                last = ts
+    sessions = [s for s in sessions if s.turns]
+    sessions.sort(key=lambda s: s.start)
+    if sessions:
+        first = sessions[0].start
+        for s in sessions:
+            s.start -= first
+    return sessions
+
+async def replay_session(app, recorder, session, index, speed, start_delay):
+    # speed=None replays as fast as possible (no arrival gaps or think time).
+    if start_delay:
+        await asyncio.sleep(start_delay)
+    pid = f"replay_{index:05d}"
+    t0 = time.perf_counter()
+    _, _, _, _, session_key, _ = await app.init_from_request(fake_request(pid, session.q, session.ant, session.cor))
+    recorder.inits.append(time.perf_counter() - t0)
+    for i, (think, message) in enumerate(session.turns):
+        if speed and think:
+            await asyncio.sleep(think / speed)
+        transcript = await recorder.turn(app, message, session_key, pid, session.q, session.ant, session.cor,
+                                         condition=session.condition, first_turn=i == 0)
+        if transcript is None:
+            break
+
+def per_condition(recorder):
+    groups = {}
+    for turn in recorder.turns:
+        groups.setdefault(turn["condition"], []).append(turn)
+    return {
+        condition: {
+            "turns": len(turns),
+            "ttft_seconds": percentiles([t["ttft"] for t in turns if t["ttft"] is not None]),
+            "turn_seconds": percentiles([t["duration"] for t in turns]),
+        }
+        for condition, turns in sorted(groups.items())
+    }
+
+async def replay(app, sessions, speed, concurrent=False, ramp_s=0.0):
+    # Recorded arrival times (scaled by speed) unless concurrent, in which case
+    # all sessions start within ramp_s.
+    recorder = TurnRecorder(app.WAITING_MESSAGE.split("{")[0])
+    monitor = LoopLagMonitor()
+    monitor.start()
+    started = time.perf_counter()
+
+    def delay(i, s):
+        if concurrent:
+            return ramp_s * i / len(sessions) if sessions else 0
+        return s.start / speed if speed else 0
+
+    await asyncio.gather(*[replay_session(app, recorder, s, i, speed, delay(i, s))
+                           for i, s in enumerate(sessions)])
+    wall = time.perf_counter() - started
+    await monitor.stop()
+    summary = recorder.summary()
+    attempted = summary["turns"] + summary["errors"]
+    summary.update({
+        "sessions": len(sessions),
+        "wall_seconds": wall,
+        "error_rate": summary["errors"] / attempted if attempted else 0.0,
+        "loop_lag_seconds": percentiles(monitor.samples),
+        "per_condition": per_condition(recorder),
+    })
+    return summary
+
+def slo_breaches(summary, slo):
+    breaches = []
+    ttft = summary["ttft_seconds"]["p95"]
+    turn = summary["stream_seconds"]["p95"]
+    if ttft is not None and ttft > slo["ttft_p95"]:
+        breaches.append(f"ttft p95 {ttft:.2f}s > {slo['ttft_p95']}s")
+    if turn is not None and turn > slo["turn_p95"]:
+        breaches.append(f"turn p95 {turn:.2f}s > {slo['turn_p95']}s")
+    if summary["error_rate"] > slo["error_rate"]:
+        breaches.append(f"error rate {summary['error_rate']:.3f} > {slo['error_rate']}")
+    return breaches
+
+async def warm_up(app, sessions, n):
+    # Untimed: pays for lazy imports and the first upstream connections.
+    if n:
+        await replay(app, sessions[:n], None, concurrent=True)
+
+async def search(app, sessions, levels, speed, ramp_s, slo, warmup=1):
+    await warm_up(app, sessions, warmup)
+    results, breaking = [], None
+    for level in levels:
+        picked = [sessions[i % len(sessions)] for i in range(level)]
+        summary = await replay(app, picked, speed, concurrent=True, ramp_s=ramp_s)
+        breaches = slo_breaches(summary, slo)
+        results.append({"concurrency": level, "breaches": breaches, **summary})
+        print(f"[bench] concurrency {level}: ttft p95={summary['ttft_seconds']['p95']} "
+              f"errors={summary['errors']} {'BREAK: ' + '; '.join(breaches) if breaches else 'ok'}", flush=True)
+        if breaches:
+            breaking = level
+            break
+    return {"levels": results, "first_breaking_concurrency": breaking, "slo": slo}
+
+def parse_speed(value):
+    if value == "max":
+        return None
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or 'max'")
+    return speed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded chat sessions against a mock upstream.")
+    parser.add_argument("--trace-dir", default=os.getenv("APP_DATA_DIR", "./user_data"),
+                        help="chat logs to replay (per-pid files and/or segments/)")
+    parser.add_argument("--speed", type=parse_speed, default=1.0, help="time compression factor, or 'max'")
+    parser.add_argument("--limit", type=int, default=None, help="replay only the first N sessions")
+    parser.add_argument("--search", default=None,
+                        help="comma-separated concurrency levels; stop at the first that breaks the SLOs")
+    parser.add_argument("--ramp-s", type=float, default=1.0, help="start-up spread for --search levels")
+    parser.add_argument("--slo-ttft-p95", type=float, default=2.0)
+    parser.add_argument("--slo-turn-p95", type=float, default=30.0)
+    parser.add_argument("--slo-error-rate", type=float, default=0.01)
+    parser.add_argument("--warmup", type=int, default=1, help="untimed sessions replayed first")
+    parser.add_argument("--match-response-length", action="store_true",
+                        help="set the mock's response length to the median recorded reply")
+    parser.add_argument("--upstream-url", default=None)
+    parser.add_argument("--data-dir", default=None, help="APP_DATA_DIR for the replay (default: a temp dir)")
+    parser.add_argument("--out", default=None)
+    add_mock_args(parser)
+    args = parser.parse_args(argv)
+
+    # Read the trace before the app is imported: it logs to its own data dir.
+    sessions = load_sessions(args.trace_dir)[:args.limit]
+    if not sessions:
+        sys.exit(f"no replayable sessions in {args.trace_dir}")
+    reply_words = [n for s in sessions for n in s.reply_words]
+    if args.match_response_length and reply_words:
+        args.response_tokens = max(1, int(statistics.median(reply_words)))
+    if os.path.abspath(args.data_dir or "") == os.path.abspath(args.trace_dir):
+        sys.exit("--data-dir must not be the trace directory")
+
+    mock = None
+    if args.upstream_url is None:
+        mock = MockServer(config_from_args(args)).start()
+    prepare_environment(args, args.upstream_url or mock.base_url)
+    import app
+
+    slo = {"ttft_p95": args.slo_ttft_p95, "turn_p95": args.slo_turn_p95, "error_rate": args.slo_error_rate}
+    try:
+        if args.search:
+            levels = [int(x) for x in args.search.split(",") if x]
+            results = asyncio.run(search(app, sessions, levels, args.speed, args.ramp_s, slo, args.warmup))
+        else:
+            async def _run():
+                await warm_up(app, sessions, args.warmup)
+                return await replay(app, sessions, args.speed)
+            results = asyncio.run(_run())
+            results["breaches"] = slo_breaches(results, slo)
+    finally:
+        if mock is not None:
+            mock.stop()
+
+    conditions = {}
+    for s in sessions:
+        conditions[s.condition] = conditions.get(s.condition, 0) + 1
+    results["trace"] = {
+        "sessions": len(sessions),
+        "turns": sum(len(s.turns) for s in sessions),
+        "conditions": conditions,
+        "think_seconds": percentiles([t for s in sessions for t, _ in s.turns[1:]]),
+        "reply_words": percentiles(reply_words),
+    }
+    if mock is not None:
+        results["upstream"] = dict(mock.stats)
+    result = {
+        "meta": {
+            "name": "replay",
+            "commit": git_commit(),
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    out = save(result, args.out)
+    if args.search:
+        print(f"[bench] first breaking concurrency: {results['first_breaking_concurrency']}", flush=True)
+    else:
+        print(f"[bench] replayed {results['turns']} turns from {results['sessions']} sessions in "
+              f"{results['wall_seconds']:.1f}s; ttft p95={results['ttft_seconds']['p95']}; "
+              f"SLO breaches: {results['breaches'] or 'none'}", flush=True)
+    print(f"[bench] results written to {out}", flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import os
+import argparse, datetime, json, platform, subprocess, sys
+
+from bench.loadgen import git_commit, percentiles, save
+
+# Cold-start benchmark: imports app.py in fresh interpreters, with
+# -X importtime, and records the total import time, the slowest top-level
+# imports and the local warm-up steps, so start-up can be compared across
+# releases:
+#
+#   python -m bench.startup --runs 5 --out bench/results/startup.json
+
+PROBE = """
+import json, time
+t0 = time.perf_counter()
+import app, warmup
+imported = time.perf_counter() - t0
+warmup.warm_local()
+print("STARTUP " + json.dumps({"import_seconds": imported, "app_import_seconds": app.import_seconds,
+                               "warmup": warmup.readiness.snapshot()["steps"]}))
+"""
+
+def parse_importtime(stderr, depth=1, top=15):
+    # Lines look like "import time:  self [us] | cumulative | imported package",
+    # with nested imports indented two spaces per level. Depth 1 is what
+    # app.py itself imports.
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2][1:]
+        if (len(name) - len(name.lstrip(" "))) // 2 != depth:
+            continue
+        modules[name.strip()] = int(fields[1]) / 1e6
+    return sorted(modules.items(), key=lambda kv: kv[1], reverse=True)[:top]
+
+def probe(env):
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", PROBE], env=env,
+                          capture_output=True, text=True)
+    result = None
+    for line in proc.stdout.splitlines():
+        if line.startswith("STARTUP "):
+            result = json.loads(line[len("STARTUP "):])
+    if result is None:
+        raise RuntimeError(f"probe failed ({proc.returncode}): {proc.stderr[-2000:]}")
+    result["top_imports"] = parse_importtime(proc.stderr)
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cold-start benchmark for app.py.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args(argv)
+
+    env = {**os.environ, "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY", "bench"), "METRICS_PORT": "0"}
+    runs = [probe(env) for _ in range(args.runs)]
+    steps = sorted({step for run in runs for step, r in run["warmup"].items() if r})
+    results = {
+        "runs": runs,
+        "import_seconds": percentiles([r["import_seconds"] for r in runs]),
+        "warmup_seconds": {step: percentiles([r["warmup"][step]["seconds"] for r in runs if r["warmup"].get(step)])
+                           for step in steps},
+        "warmup_ok": all(r["ok"] for run in runs for r in run["warmup"].values() if r),
+    }
+    result = {
+        "meta": {
+            "name": "startup",
+            "commit": git_commit(),
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    out = save(result, args.out)
+    print(f"[bench] import p50={results['import_seconds']['p50']:.2f}s max={results['import_seconds']['max']:.2f}s; "
+          f"warm-up ok={results['warmup_ok']}", flush=True)
+    print(f"[bench] results written to {out}", flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -1,81 +1,183 @@
+import hashlib, pathlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from types import MappingProxyType
+
 import tiktoken
 
+from metrics import Counter, Histogram, FAST_BUCKETS, span
+
 MAX_TOKENS = 16000
+# The prompt and question files sit next to this module.
+PROMPT_DIR = pathlib.Path(__file__).resolve().parent
+
+BUILD_INPUT_SECONDS = Histogram("chat_build_input_seconds", "Time spent in build_input_from_history.",
+                                buckets=FAST_BUCKETS)
+TRUNCATE_SECONDS = Histogram("chat_truncate_history_seconds", "Time spent in truncate_history.",
+                             buckets=FAST_BUCKETS)
+TRUNCATIONS = Counter("chat_truncations_total", "Inputs that had to be truncated to fit MAX_TOKENS.")
+TRUNCATED_MESSAGES = Counter("chat_truncated_messages_total", "Messages dropped by truncate_history.")
 
 def get_db_sys_prompt(ant):
     if ant:
-        with open(f"SYS_PROMPT_ANT.txt", "r") as f:
+        with open(PROMPT_DIR / "SYS_PROMPT_ANT.txt", "r") as f:
             sys_prompt = f.read()
     else:
-        with open(f"SYS_PROMPT.txt", "r") as f:
+        with open(PROMPT_DIR / "SYS_PROMPT.txt", "r") as f:
             sys_prompt = f.read()
     return sys_prompt
 
 def get_db_sys_prompt_beta():
-    with open(f"QUESTIONS.txt", "r") as f:
+    with open(PROMPT_DIR / "QUESTIONS.txt", "r") as f:
         questions = f.read()
-    with open(f"SYS_PROMPT_BETA.txt", "r") as f:
+    with open(PROMPT_DIR / "SYS_PROMPT_BETA.txt", "r") as f:
         sys_prompt = f.read()
-    with open(f"ANSWERS_CORRECT.txt", "r") as f:
+    with open(PROMPT_DIR / "ANSWERS_CORRECT.txt", "r") as f:
         answers = f.read()
 
     return sys_prompt.format(QUESTIONS=questions, ANSWERS=answers)
 
-def get_question(q):
-    with open(f"QUESTIONS.txt", "r") as f:
-        questions = f.readlines()
-    return questions[int(q[-1])-1].split(". ")[1]
+QUESTION_LABELS = ("Q1", "Q2", "Q3", "Q4", "Q5", "Q6")
+Q0_USER = "How many r's are there in strawberry?"
+Q0_ASSISTANT = "There are **three** “r” letters in the word **strawberry**."
+
+@dataclass(frozen=True)
+class Scenario:
+    q: str
+    ant: bool
+    correct: bool
+    messages: tuple
+    token_counts: tuple
+
+    def history(self):
+        return [{"role": role, "content": content} for role, content in self.messages]
+
+class ScenarioRegistry:
+
+    def __init__(self, scenarios):
+        self._scenarios = MappingProxyType(dict(scenarios))
+
+    def __len__(self):
+        return len(self._scenarios)
+
+    def __iter__(self):
+        return iter(self._scenarios.values())
+
+    def get(self, q, ant, correct):
+        key = (q, bool(ant), bool(correct))
+        try:
+            return self._scenarios[key]
+        except KeyError:
+            raise ValueError(f"unknown scenario q={q!r} ant={ant!r} correct={correct!r}") from None
+
+def load_scenario_registry(model="gpt-4.1"):
+    with open(PROMPT_DIR / "QUESTIONS.txt", "r") as f:
+        lines = f.readlines()
+    if len(lines) < len(QUESTION_LABELS):
+        raise ValueError(f"QUESTIONS.txt has {len(lines)} questions, expected {len(QUESTION_LABELS)}")
+
+    questions = {}
+    for label, line in zip(QUESTION_LABELS, lines):
+        parts = line.split(". ")
+        if len(parts) < 2 or parts[0].strip() != label[1:]:
+            raise ValueError(f"QUESTIONS.txt line for {label} is malformed: {line!r}")
+        questions[label] = parts[1]
+
+    scenarios = {}
+    for ant in (False, True):
+        sys_prompt = get_db_sys_prompt(ant)
+        answers = {True: correct_answers(ant), False: incorrect_answers(ant)}
+        for correct in (False, True):
+            turns = [(label, ("user", text), ("assistant", answers[correct].get(label[1:])))
+                     for label, text in questions.items()]
+            turns.append(("Q0", ("user", Q0_USER), ("assistant", Q0_ASSISTANT)))
+            for label, user_msg, assistant_msg in turns:
+                if not assistant_msg[1]:
+                    raise ValueError(f"missing canned answer for {label} ant={ant} correct={correct}")
+                messages = (("system", sys_prompt), user_msg, assistant_msg)
+                counts = tuple(count_text_tokens(content, model=model) for _, content in messages)
+                scenarios[(label, ant, correct)] = Scenario(label, ant, correct, messages, counts)
+
+    return ScenarioRegistry(scenarios)
+
+@lru_cache(maxsize=None)
+def get_scenario_registry():
+    return load_scenario_registry()
 
 def build_init_history(q, ant, correct):
-
-    history = []
-    history.append({"role": "system", "content": get_db_sys_prompt(ant)})
-
-    if q == "Q0":
-        history.append({"role": "user", "content": "How many r's are there in strawberry?"})
-        history.append({"role": "assistant", "content": "There are **three** “r” letters in the word **strawberry**."})
-        return history
-
     correct_flag = (correct == "1")
-    
-    question = get_question(q)
-    history.append({"role": "user", "content": question})
-    if correct_flag:
-        correct_answer = correct_answers(ant)[q[-1]]
-        history.append({"role": "assistant", "content": correct_answer})
-    else:
-        incorrect_answer = incorrect_answers(ant)[q[-1]]
-        history.append({"role": "assistant", "content": incorrect_answer})
+    return get_scenario_registry().get(q, ant, correct_flag).history()
+
+# Roles sent upstream; the system prompt stays out of the input.
+INPUT_ROLES = ("user", "assistant")
+
+def build_input_from_history(message, history, token_counts=None, prefix=None):
+    # token_counts, if given, holds the token count of each message in history
+    # so truncation does not need to look them up again. prefix, if given, is
+    # (input messages, their token counts) for history, kept ahead of time.
+
+    with span(BUILD_INPUT_SECONDS):
+        if prefix is not None:
+            parts, counts = list(prefix[0]), list(prefix[1])
+        else:
+            parts = []
+            counts = [] if token_counts is not None else None
+            for i, msg in enumerate(history):
+                if msg["role"] in INPUT_ROLES:
+                    parts.append({"role": msg["role"], "content": msg["content"]})
+                    if counts is not None:
+                        counts.append(token_counts[i])
+        parts.append({"role": "user", "content": message})
+        if counts is not None:
+            counts.append(count_text_tokens(message))
+
+        parts = truncate_history(parts, MAX_TOKENS, counts=counts)
 
-    return history
-    
-def build_input_from_history(message, history):
-
-    parts = []
-    for msg in history:
-        if msg["role"] == "user":
-            parts.append({"role": "user", "content": msg["content"]})
-        if msg["role"] == "assistant":
-            parts.append({"role": "assistant", "content": msg["content"]})
-    parts.append({"role": "user", "content": message})
+    return parts
 
-    parts = truncate_history(parts, MAX_TOKENS)
+ENCODING_FALLBACK = "cl100k_base"
+TOKEN_MEMO_SIZE = 4096
 
-    return parts
+_token_memo = OrderedDict()
 
-def count_tokens(messages, model="gpt-4.1"):
+@lru_cache(maxsize=None)
+def get_encoder(model="gpt-4.1"):
     try:
-        enc = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
-        enc = tiktoken.get_encoding("cl100k_base")
-    num_tokens = 0
-    for msg in messages:
-        num_tokens += len(enc.encode(msg["content"]))
-    return num_tokens
-
-def truncate_history(messages, max_tokens=MAX_TOKENS, model="gpt-4.1"):
-    while count_tokens(messages, model=model) > max_tokens and len(messages) > 2:
-        messages.pop(1)
+        return tiktoken.get_encoding(ENCODING_FALLBACK)
+
+def count_text_tokens(text, model="gpt-4.1"):
+    key = (model, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+    n = _token_memo.get(key)
+    if n is not None:
+        _token_memo.move_to_end(key)
+        return n
+    n = len(get_encoder(model).encode(text))
+    _token_memo[key] = n
+    if len(_token_memo) > TOKEN_MEMO_SIZE:
+        _token_memo.popitem(last=False)
+    return n
+
+def count_tokens(messages, model="gpt-4.1"):
+    return sum(count_text_tokens(msg["content"], model=model) for msg in messages)
+
+def truncate_history(messages, max_tokens=MAX_TOKENS, model="gpt-4.1", counts=None):
+    # Drop the oldest messages after the first one until the running total fits,
+    # always keeping at least two messages (same policy as popping index 1 in a loop).
+    with span(TRUNCATE_SECONDS):
+        if counts is None:
+            counts = [count_text_tokens(msg["content"], model=model) for msg in messages]
+        total = sum(counts)
+        drop = 0
+        while total > max_tokens and len(messages) - drop > 2:
+            drop += 1
+            total -= counts[drop]
+        if drop:
+            del messages[1:1 + drop]
+            TRUNCATIONS.inc()
+            TRUNCATED_MESSAGES.inc(drop)
     return messages
 
 def correct_answers(ant=False):
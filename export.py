@@ -0,0 +1,322 @@
+import os
+import argparse, csv, datetime, json, pathlib, sqlite3, sys, time
+
+from log_segments import chat_log_files
+
+# Incremental analytics export. Streams the chat logs (per-pid files and
+# segments from logger.py) and the tracker CSVs (from collector.py) into
+# Parquet files partitioned by question, one row per event:
+#
+#   export/events/question=Q1/part-000003-0000.parquet
+#
+# Tracker rows are joined to the chat condition (ant/correct) on
+# pid == responseId and question. Read offsets, the conditions seen so far
+# and the run log live in export/_state.sqlite, so a rerun only reads bytes
+# appended since the last one. Memory is bounded by --batch-rows. Per-pid
+# files already copied by log_segments.py migrate are read only once (see
+# log_segments.chat_log_files).
+#
+# The chat logs are append-only. A tracker CSV can be rewritten (snapshot
+# sync, compaction). A rewritten CSV is exported again in full under a new
+# generation, and rows from older generations of that responseId are
+# superseded. load_events() applies this. The same happens when the chat log
+# first gives a condition for a responseId whose tracker rows went out
+# without it.
+#
+#   python export.py                      # needs pyarrow
+#   python export.py --data-dir user_data --tracker-dir QualtricsTracker/logs --out export
+
+EXPORT_DIR = os.getenv("EXPORT_DIR", "./export")
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "50000"))
+DATA_DIR = os.getenv("APP_DATA_DIR", "./user_data")
+TRACKER_DIR = os.getenv("TRACKER_LOG_DIR", "QualtricsTracker/logs")
+
+COLUMNS = ("origin", "ts", "pid", "q", "kind", "ant", "correct", "text",
+           "url", "source", "search_results", "log_id", "generation", "run")
+
+def schema():
+    import pyarrow as pa
+    return pa.schema([
+        ("origin", pa.string()),
+        ("ts", pa.timestamp("ms", tz="UTC")),
+        ("pid", pa.string()),
+        ("q", pa.string()),
+        ("kind", pa.string()),
+        ("ant", pa.bool_()),
+        ("correct", pa.bool_()),
+        ("text", pa.string()),
+        ("url", pa.string()),
+        ("source", pa.string()),
+        ("search_results", pa.list_(pa.string())),
+        ("log_id", pa.string()),
+        ("generation", pa.int32()),
+        ("run", pa.int32()),
+    ])
+
+def parse_ts(value):
+    if not value:
+        return None
+    value = str(value)
+    # logger.py writes "...+00:00Z"; the extension writes "...Z".
+    if value.endswith("Z"):
+        value = value[:-1]
+        if not value.endswith("+00:00"):
+            value += "+00:00"
+    try:
+        ts = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return ts if ts.tzinfo else ts.replace(tzinfo=datetime.timezone.utc)
+
+def parse_flag(value):
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower() if value is not None else ""
+    if value in ("1", "true", "yes"):
+        return True
+    if value in ("0", "false", "no"):
+        return False
+    return None
+
+def normalize_q(value):
+    value = str(value or "").strip().upper()
+    return value or None
+
+class State:
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, inode INTEGER, offset INTEGER, generation INTEGER);
+            CREATE TABLE IF NOT EXISTS conditions (
+                pid TEXT, q TEXT, ant INTEGER, correct INTEGER, PRIMARY KEY (pid, q));
+            CREATE TABLE IF NOT EXISTS runs (
+                run INTEGER PRIMARY KEY AUTOINCREMENT, started TEXT, finished TEXT, rows INTEGER);
+        """)
+
+    def unfinished_runs(self):
+        return [r for (r,) in self.db.execute("SELECT run FROM runs WHERE finished IS NULL")]
+
+    def start_run(self):
+        cur = self.db.execute("INSERT INTO runs (started) VALUES (?)",
+                              (datetime.datetime.now(datetime.timezone.utc).isoformat(),))
+        self.db.commit()
+        return cur.lastrowid
+
+    def files(self):
+        return {path: (inode, offset, generation)
+                for path, inode, offset, generation in self.db.execute("SELECT * FROM files")}
+
+    def save_file(self, path, inode, offset, generation):
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (path, inode, offset, generation))
+
+    def save_condition(self, pid, q, ant, correct):
+        # True if this adds to or changes what is known for (pid, q).
+        cur = self.db.execute("""INSERT INTO conditions VALUES (?, ?, ?, ?)
+                                 ON CONFLICT (pid, q) DO UPDATE SET
+                                   ant = COALESCE(excluded.ant, ant), correct = COALESCE(excluded.correct, correct)
+                                 WHERE ant IS NOT COALESCE(excluded.ant, ant)
+                                    OR correct IS NOT COALESCE(excluded.correct, correct)""",
+                              (pid, q, ant, correct))
+        return cur.rowcount > 0
+
+    def conditions(self, pid):
+        return {q: (None if ant is None else bool(ant), None if correct is None else bool(correct))
+                for q, ant, correct in self.db.execute("SELECT q, ant, correct FROM conditions WHERE pid = ?", (pid,))}
+
+    def finish_run(self, run, rows):
+        # Offsets and conditions become visible together with the run's files.
+        self.db.execute("UPDATE runs SET finished = ?, rows = ? WHERE run = ?",
+                        (datetime.datetime.now(datetime.timezone.utc).isoformat(), rows, run))
+        self.db.commit()
+
+class PartitionedWriter:
+    # Buffers rows per question and writes a Parquet part file per partition
+    # whenever batch_rows rows are buffered in total.
+
+    def __init__(self, out_dir, run, batch_rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self._pa, self._pq = pa, pq
+        self.schema = schema()
+        self.out_dir = pathlib.Path(out_dir) / "events"
+        self.run = run
+        self.batch_rows = batch_rows
+        self._buffers = {}
+        self._buffered = 0
+        self._parts = 0
+        self.rows = 0
+
+    def add(self, row):
+        columns = self._buffers.get(row["q"])
+        if columns is None:
+            columns = self._buffers[row["q"]] = {name: [] for name in COLUMNS}
+        for name in COLUMNS:
+            columns[name].append(row.get(name))
+        self._buffered += 1
+        if self._buffered >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        for q, columns in self._buffers.items():
+            table = self._pa.Table.from_pydict(columns, schema=self.schema)
+            part_dir = self.out_dir / f"question={q or 'none'}"
+            part_dir.mkdir(parents=True, exist_ok=True)
+            path = part_dir / f"part-{self.run:06d}-{self._parts:04d}.parquet"
+            self._pq.write_table(table, path.with_suffix(".tmp"))
+            os.replace(path.with_suffix(".tmp"), path)
+            self._parts += 1
+            self.rows += table.num_rows
+        self._buffers.clear()
+        self._buffered = 0
+
+def _remove_run_files(out_dir, runs):
+    # Part files of runs that never finished; their input is read again.
+    for run in runs:
+        for path in (pathlib.Path(out_dir) / "events").glob(f"*/part-{run:06d}-*"):
+            path.unlink()
+
+def _complete_lines(f, offset):
+    # Yields (line, end offset) for every complete line after offset.
+    f.seek(offset)
+    for raw in f:
+        if not raw.endswith(b"\n"):
+            return
+        offset += len(raw)
+        yield raw, offset
+
+def export_chat(path, start, state, writer, skip=None, learned=None):
+    # learned, if given, collects the pids whose conditions changed.
+    end = start
+    with open(path, "rb") as f:
+        for raw, end in _complete_lines(f, start):
+            try:
+                rec = json.loads(raw)
+            except ValueError:
+                continue
+            if not isinstance(rec, dict) or (skip is not None and skip(rec)):
+                continue
+            pid = str(rec.get("pid") or "")
+            q = normalize_q(rec.get("q"))
+            ant, correct = parse_flag(rec.get("ant")), parse_flag(rec.get("correct"))
+            if pid and q:
+                if (ant is not None or correct is not None) and state.save_condition(pid, q, ant, correct):
+                    if learned is not None:
+                        learned.add(pid)
+                if ant is None or correct is None:
+                    known_ant, known_correct = state.conditions(pid).get(q, (None, None))
+                    ant = known_ant if ant is None else ant
+                    correct = known_correct if correct is None else correct
+            writer.add({
+                "origin": "chat", "ts": parse_ts(rec.get("ts")), "pid": pid, "q": q,
+                "kind": rec.get("kind"), "ant": ant, "correct": correct, "text": rec.get("text"),
+                "generation": 0, "run": writer.run,
+            })
+    return end
+
+def export_tracker(path, start, generation, state, writer):
+    rid = path.stem
+    conditions = state.conditions(rid)
+    end = start
+    with open(path, "rb") as f:
+        header = f.readline().decode("utf-8").rstrip("\r\n")
+        columns = next(csv.reader([header]), [])
+        start = max(start, f.tell())
+        for raw, end in _complete_lines(f, start):
+            row = next(csv.reader([raw.decode("utf-8")]), None)
+            if not row:
+                continue
+            rec = dict(zip(columns, row))
+            q = normalize_q(rec.get("question_id"))
+            ant, correct = conditions.get(q, (None, None))
+            results = rec.get("search_results") or ""
+            writer.add({
+                "origin": "tracker", "ts": parse_ts(rec.get("timestamp_iso")), "pid": rid, "q": q,
+                "kind": "navigation", "ant": ant, "correct": correct,
+                "url": rec.get("url") or None, "source": rec.get("source") or None,
+                "search_results": results.split(" | ") if results else [],
+                "log_id": rec.get("log_id") or None,
+                "generation": generation, "run": writer.run,
+            })
+    return end
+
+def run_export(data_dir=DATA_DIR, tracker_dir=TRACKER_DIR, out_dir=EXPORT_DIR, batch_rows=EXPORT_BATCH_ROWS):
+    out_dir = pathlib.Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    state = State(out_dir / "_state.sqlite")
+    _remove_run_files(out_dir, state.unfinished_runs())
+    run = state.start_run()
+    writer = PartitionedWriter(out_dir, run, batch_rows)
+    known = state.files()
+    started = time.perf_counter()
+    stats = {"chat_files": 0, "tracker_files": 0, "regenerated": 0}
+
+    # Chat first, so tracker rows can be joined to conditions from this run.
+    # A tracker CSV exported before its pid's conditions were known (or
+    # while they were different) is exported again under a new generation.
+    learned = set()
+    sources = [("chat", p, skip) for p, skip in chat_log_files(data_dir)]
+    sources += [("tracker", p, None) for p in sorted(pathlib.Path(tracker_dir).glob("*.csv"))]
+    for origin, path, skip in sources:
+        st = path.stat()
+        inode, offset, generation = known.get(str(path), (None, 0, 0))
+        stale = origin == "tracker" and inode is not None and path.stem in learned
+        if inode == st.st_ino and st.st_size == offset and not stale:
+            continue
+        if inode is not None and (inode != st.st_ino or st.st_size < offset or stale):
+            # Replaced, truncated or joined to outdated conditions: export it
+            # again from the start.
+            offset = 0
+            generation += 1
+            stats["regenerated"] += 1
+        if origin == "chat":
+            offset = export_chat(path, offset, state, writer, skip, learned)
+        else:
+            offset = export_tracker(path, offset, generation, state, writer)
+        state.save_file(str(path), st.st_ino, offset, generation)
+        stats[f"{origin}_files"] += 1
+
+    writer.flush()
+    state.finish_run(run, writer.rows)
+    stats.update(run=run, rows=writer.rows, seconds=round(time.perf_counter() - started, 3))
+    return stats
+
+def load_events(out_dir=EXPORT_DIR, **filters):
+    # The exported events as one pyarrow Table, with tracker rows from
+    # superseded generations dropped. filters are passed to pyarrow.dataset.
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    out_dir = pathlib.Path(out_dir)
+    dataset = ds.dataset(out_dir / "events", format="parquet", partitioning="hive")
+    table = dataset.to_table(**filters)
+    current = {pathlib.Path(path).stem: generation
+               for path, (_, _, generation) in State(out_dir / "_state.sqlite").files().items()
+               if path.endswith(".csv") and generation}
+    if not current or table.num_rows == 0:
+        return table
+    keep = [origin != "tracker" or generation >= current.get(pid, 0)
+            for origin, pid, generation in zip(table["origin"].to_pylist(), table["pid"].to_pylist(),
+                                               table["generation"].to_pylist())]
+    return table.filter(pa.array(keep))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Incrementally export chat logs and tracker CSVs to Parquet.")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--tracker-dir", default=TRACKER_DIR)
+    parser.add_argument("--out", default=EXPORT_DIR)
+    parser.add_argument("--batch-rows", type=int, default=EXPORT_BATCH_ROWS)
+    args = parser.parse_args(argv)
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        sys.exit("export needs pyarrow: pip install pyarrow")
+
+    stats = run_export(args.data_dir, args.tracker_dir, args.out, args.batch_rows)
+    print(f"[export] run {stats['run']}: {stats['rows']} rows from {stats['chat_files']} chat and "
+          f"{stats['tracker_files']} tracker files ({stats['regenerated']} re-exported) "
+          f"in {stats['seconds']}s", flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+import os
+import argparse, json, pathlib, re, sys, time, uuid
+
+# Segmented log layout: records from every pid go to append-only segment
+# files (<prefix>-<seq>.jsonl), rotated by size or age. Each segment has an
+# index next to it (<prefix>-<seq>.idx) with one JSON line [pid, offset,
+# length] per record, so one pid's records can be read without scanning
+# everything. Index lines are written after their records. Because every
+# record carries its pid, a missing or short index can be rebuilt from the
+# segment.
+#
+#   python log_segments.py migrate            # per-pid files -> segments
+#   python log_segments.py read <pid>         # print one pid's records
+#   python log_segments.py reindex            # rebuild missing/short indexes
+
+SEGMENT_MAX_BYTES = int(os.getenv("APP_LOG_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+SEGMENT_MAX_SECONDS = float(os.getenv("APP_LOG_SEGMENT_SECONDS", "3600"))
+
+_segment_re = re.compile(r"^(?P<prefix>.+)-(?P<seq>\d{8})\.jsonl$")
+_pid_re = re.compile(r"[^A-Za-z0-9._-]+")
+
+def slugify(pid: str) -> str:
+    # Per-pid file name (without .jsonl) in the per_pid layout.
+    pid = (pid or "").strip().lower()
+    pid = _pid_re.sub("_", pid)
+    return pid or f"anon_{uuid.uuid4().hex[:8]}"
+
+def segment_paths(root, prefix=None):
+    # (prefix, seq, path) for every segment under root, by sequence number.
+    # Only segments of one prefix are in time order; see SegmentIndex.read.
+    found = []
+    for path in pathlib.Path(root).glob("*.jsonl"):
+        m = _segment_re.match(path.name)
+        if m and (prefix is None or m["prefix"] == prefix):
+            found.append((m["prefix"], int(m["seq"]), path))
+    return sorted(found, key=lambda item: (item[1], item[0]))
+
+def chat_log_files(data_dir):
+    # (path, skip) for every chat log under data_dir: the per-pid files, then
+    # the segments. A migrate without --remove leaves each per-pid file next
+    # to its copy in the migrated segments; skip(record) is true for those
+    # copies while the per-pid file still exists, so every record is read
+    # once. skip is None for files that need no filtering.
+    data_dir = pathlib.Path(data_dir)
+    root = data_dir / "segments"
+    per_pid = sorted(data_dir.glob("*.jsonl"))
+    manifest = root / "migrated.txt"
+    listed = set(manifest.read_text(encoding="utf-8").split("\n")) if manifest.exists() else set()
+    kept = {p.name for p in per_pid} & listed
+
+    def skip(record):
+        return f"{slugify(str(record.get('pid') or ''))}.jsonl" in kept
+
+    files = [(p, None) for p in per_pid]
+    for prefix, _, path in sorted(segment_paths(root), key=lambda item: item[2].name):
+        files.append((path, skip if kept and prefix == "migrated" else None))
+    return files
+
+def index_path(segment):
+    return segment.with_suffix(".idx")
+
+class SegmentLog:
+    # Writer side. Not thread-safe: LogWriter's thread is the only caller.
+
+    def __init__(self, root, prefix="seg", max_bytes=SEGMENT_MAX_BYTES, max_seconds=SEGMENT_MAX_SECONDS):
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        existing = segment_paths(self.root, prefix)
+        # Always start a fresh segment, so a torn tail from a crash is never
+        # appended to.
+        self._seq = existing[-1][1] if existing else 0
+        self._seg = None
+        self._idx = None
+        self._size = 0
+        self._opened_at = 0.0
+        self.dirty = False
+
+    @property
+    def path(self):
+        return self.root / f"{self.prefix}-{self._seq:08d}.jsonl"
+
+    def _rotate(self):
+        self.close()
+        self._seq += 1
+        self._seg = open(self.path, "ab")
+        self._idx = open(index_path(self.path), "a", encoding="utf-8")
+        self._size = self._seg.tell()
+        self._opened_at = time.monotonic()
+
+    def append(self, records):
+        # records: [(pid, line)]. One write per file per call.
+        if (self._seg is None or self._size >= self.max_bytes
+                or time.monotonic() - self._opened_at >= self.max_seconds):
+            self._rotate()
+        data, entries = [], []
+        offset = self._size
+        for pid, line in records:
+            raw = (line + "\n").encode("utf-8")
+            entries.append(json.dumps([pid, offset, len(raw)], ensure_ascii=False))
+            data.append(raw)
+            offset += len(raw)
+        self._seg.write(b"".join(data))
+        self._seg.flush()
+        self._idx.write("\n".join(entries) + "\n")
+        self._idx.flush()
+        self._size = offset
+        self.dirty = True
+
+    def sync(self):
+        if self._seg is not None and self.dirty:
+            os.fsync(self._seg.fileno())
+            os.fsync(self._idx.fileno())
+        self.dirty = False
+
+    def close(self):
+        # Every step runs even if an earlier one fails (e.g. ENOSPC on the
+        # final flush), and the handles are always dropped, so the next
+        # append starts a fresh segment.
+        if self._seg is None:
+            return
+        seg, idx = self._seg, self._idx
+        try:
+            self.sync()
+        finally:
+            self._seg = self._idx = None
+            self.dirty = False
+            try:
+                seg.close()
+            finally:
+                idx.close()
+
+class SegmentIndex:
+    # Reader side: pid -> [(segment path, offset, length)] over all segments.
+    # refresh() picks up records appended since the last call.
+
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+        self._entries = {}
+        self._read_upto = {}   # index path -> bytes consumed
+
+    def refresh(self):
+        for _, _, segment in segment_paths(self.root):
+            idx = index_path(segment)
+            if not idx.exists():
+                continue
+            start = self._read_upto.get(idx, 0)
+            with open(idx, "rb") as f:
+                f.seek(start)
+                chunk = f.read()
+            # Ignore a partially written last line; it is read next time.
+            end = chunk.rfind(b"\n") + 1
+            for line in chunk[:end].splitlines():
+                if line:
+                    pid, offset, length = json.loads(line)
+                    self._entries.setdefault(pid, []).append((segment, offset, length))
+            self._read_upto[idx] = start + end
+        return self
+
+    def pids(self):
+        return list(self._entries)
+
+    def read(self, pid):
+        records = []
+        handles = {}
+        try:
+            for segment, offset, length in self._entries.get(pid, ()):
+                f = handles.get(segment)
+                if f is None:
+                    f = handles[segment] = open(segment, "rb")
+                f.seek(offset)
+                records.append(json.loads(f.read(length)))
+        finally:
+            for f in handles.values():
+                f.close()
+        # Segments from different writers (seg-, w<i>-, migrated-) are not in
+        # time order with each other, so merge by timestamp. The sort is stable,
+        # which keeps the write order of records within the same second.
+        records.sort(key=lambda r: str(r.get("ts") or "") if isinstance(r, dict) else "")
+        return records
+
+def rebuild_index(segment):
+    # Rewrites segment's index from its records. Returns the record count.
+    entries = []
+    offset = 0
+    with open(segment, "rb") as f:
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break   # torn tail
+            try:
+                pid = json.loads(raw).get("pid", "")
+            except ValueError:
+                pid = ""
+            entries.append(json.dumps([pid, offset, len(raw)], ensure_ascii=False))
+            offset += len(raw)
+    idx = index_path(segment)
+    tmp = idx.with_suffix(".idx.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write("".join(e + "\n" for e in entries))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, idx)
+    return len(entries)
+
+def reindex(root):
+    # Rebuilds indexes that are missing or shorter than their segment.
+    rebuilt = 0
+    for _, _, segment in segment_paths(root):
+        idx = index_path(segment)
+        covered = 0
+        if idx.exists():
+            with open(idx, "rb") as f:
+                lines = [l for l in f.read().split(b"\n") if l]
+            if lines:
+                _, offset, length = json.loads(lines[-1])
+                covered = offset + length
+        if covered < segment.stat().st_size:
+            n = rebuild_index(segment)
+            rebuilt += 1
+            print(f"[log_segments] reindexed {segment.name}: {n} records", flush=True)
+    return rebuilt
+
+def migrate(data_dir, root, remove=False, batch=512):
+    # Copies every per-pid <slug>.jsonl in data_dir into segments, one file
+    # at a time so each pid's records stay contiguous. Migrated files are
+    # listed in <root>/migrated.txt and skipped on the next run.
+    data_dir = pathlib.Path(data_dir)
+    log = SegmentLog(root, prefix="migrated")
+    manifest = pathlib.Path(root) / "migrated.txt"
+    done = set(manifest.read_text(encoding="utf-8").split("\n")) if manifest.exists() else set()
+    files = records = 0
+    try:
+        with open(manifest, "a", encoding="utf-8") as m:
+            for path in sorted(data_dir.glob("*.jsonl")):
+                if path.name in done:
+                    continue
+                fallback = path.stem
+                pending = []
+                with open(path, encoding="utf-8") as f:
+                    for line in f:
+                        line = line.rstrip("\n")
+                        if not line:
+                            continue
+                        try:
+                            pid = json.loads(line).get("pid") or fallback
+                        except ValueError:
+                            print(f"[log_segments] skipping unreadable line in {path.name}", file=sys.stderr, flush=True)
+                            continue
+                        pending.append((pid, line))
+                        if len(pending) >= batch:
+                            log.append(pending)
+                            records += len(pending)
+                            pending = []
+                if pending:
+                    log.append(pending)
+                    records += len(pending)
+                log.sync()
+                m.write(path.name + "\n")
+                m.flush()
+                files += 1
+                if remove:
+                    path.unlink()
+    finally:
+        log.close()
+    print(f"[log_segments] migrated {records} records from {files} files into {root}", flush=True)
+    return files, records
+
+def main(argv=None):
+    from logger import DATA_DIR, SEGMENTS_DIR
+
+    parser = argparse.ArgumentParser(description="Tools for the segmented log layout.")
+    parser.add_argument("--data-dir", default=str(DATA_DIR))
+    parser.add_argument("--segments-dir", default=str(SEGMENTS_DIR))
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("migrate", help="copy per-pid JSONL files into segments")
+    p.add_argument("--remove", action="store_true", help="delete each per-pid file once it is migrated")
+    p = sub.add_parser("read", help="print one pid's records as JSONL")
+    p.add_argument("pid")
+    sub.add_parser("reindex", help="rebuild missing or incomplete segment indexes")
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        migrate(args.data_dir, args.segments_dir, remove=args.remove)
+    elif args.command == "read":
+        for record in SegmentIndex(args.segments_dir).refresh().read(args.pid):
+            print(json.dumps(record, ensure_ascii=False))
+    elif args.command == "reindex":
+        reindex(args.segments_dir)
+
+if __name__ == "__main__":
+    main()
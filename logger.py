@@ -1,29 +1,317 @@
 import os
-import json, uuid, pathlib, asyncio, datetime, re
+import json, pathlib, asyncio, datetime
+import atexit, fcntl, queue, sys, threading, time
+from collections import OrderedDict
+
+from metrics import Counter, Gauge, Histogram
+from log_segments import SegmentIndex, SegmentLog, slugify
 
 DATA_DIR = pathlib.Path(os.getenv("APP_DATA_DIR", "./user_data"))
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
-_pid_re = re.compile(r"[^A-Za-z0-9._-]+")
-
-def _slugify(pid: str) -> str:
-    pid = (pid or "").strip().lower()
-    pid = _pid_re.sub("_", pid)
-    return pid or f"anon_{uuid.uuid4().hex[:8]}"
+LOG_QUEUE_SIZE = int(os.getenv("APP_LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("APP_LOG_BATCH_SIZE", "512"))
+LOG_MAX_OPEN_FILES = int(os.getenv("APP_LOG_MAX_OPEN_FILES", "128"))
+# "none": flush to the OS only, "batch": fsync every file touched by a batch,
+# "interval": fsync dirty files at most every APP_LOG_FSYNC_INTERVAL seconds.
+LOG_FSYNC = os.getenv("APP_LOG_FSYNC", "interval")
+LOG_FSYNC_INTERVAL = float(os.getenv("APP_LOG_FSYNC_INTERVAL", "1.0"))
+# "per_pid": one <slug>.jsonl per pid. "segmented": shared, rotated segment
+# files with a pid index (see log_segments.py).
+LOG_LAYOUT = os.getenv("APP_LOG_LAYOUT", "per_pid")
+SEGMENTS_DIR = DATA_DIR / "segments"
+# Set by serve.py for each worker process. Workers write their own segments
+# (w<id>-<seq>.jsonl, read back together by SegmentIndex); in the per_pid
+# layout they take an exclusive flock on the file for every batch write.
+WORKER_ID = os.getenv("APP_WORKER_ID", "")
+LOG_LOCK = os.getenv("APP_LOG_LOCK", "1" if WORKER_ID else "0") == "1"
 
 def _pid_log_path(pid: str) -> pathlib.Path:
-    return DATA_DIR / f"{_slugify(pid)}.jsonl"
+    return DATA_DIR / f"{slugify(pid)}.jsonl"
 
 def _utc_now():
     return datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0).isoformat() + "Z"
 
-async def _append_jsonl(path: pathlib.Path, obj: dict):
+LOG_DURABLE_SECONDS = Histogram("log_event_durable_seconds",
+                                "Time from log_event enqueue until the record is written (and fsynced when APP_LOG_FSYNC=batch).")
+LOG_RECORDS = Counter("log_records_written_total", "Log records written to disk.")
+LOG_BLOCKED_PUTS = Counter("log_blocked_puts_total", "log_event calls that had to wait for room in the writer queue.")
+LOG_WRITE_ERRORS = Counter("log_write_errors_total", "Failed log writes, closes and fsyncs.")
+
+_STOP = object()
+
+class LogWriter:
+    # One background thread owns every log file. Records are queued in arrival
+    # order, grouped per path and written with one write() per file per batch,
+    # so lines for the same pid keep their order. With a SegmentLog the queue
+    # carries pids instead of paths and each batch becomes one segment write.
+
+    def __init__(self, queue_size=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE,
+                 max_open_files=LOG_MAX_OPEN_FILES, fsync=LOG_FSYNC,
+                 fsync_interval=LOG_FSYNC_INTERVAL, segments=None, lock=LOG_LOCK):
+        if fsync not in ("none", "batch", "interval"):
+            raise ValueError(f"unknown fsync policy {fsync!r}")
+        self.segments = segments
+        self.lock = lock
+        self.batch_size = batch_size
+        self.max_open_files = max_open_files
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._handles = OrderedDict()
+        self._dirty = set()
+        self._last_fsync = time.monotonic()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._put_lock = None
+        self._waiting = 0
+        self._closed = False
+        self._stats = {
+            "enqueued": 0,
+            "written": 0,
+            "batches": 0,
+            "fsyncs": 0,
+            "blocked_puts": 0,
+            "max_queue_depth": 0,
+            "errors": 0,
+        }
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+
+    def _enqueued(self):
+        self._stats["enqueued"] += 1
+        depth = self._queue.qsize()
+        if depth > self._stats["max_queue_depth"]:
+            self._stats["max_queue_depth"] = depth
+
+    async def put(self, path: pathlib.Path, line: str):
+        if self._closed:
+            raise RuntimeError("log writer is closed")
+        self._ensure_started()
+        # Fast path only when nobody is already waiting, otherwise a record
+        # could overtake an earlier one for the same pid.
+        if self._waiting == 0:
+            try:
+                self._queue.put_nowait((path, line, time.perf_counter()))
+                self._enqueued()
+                return
+            except queue.Full:
+                pass
+
+        self._stats["blocked_puts"] += 1
+        LOG_BLOCKED_PUTS.inc()
+        if self._put_lock is None:
+            self._put_lock = asyncio.Lock()
+        self._waiting += 1
+        try:
+            async with self._put_lock:
+                await asyncio.to_thread(self._queue.put, (path, line, time.perf_counter()))
+                self._enqueued()
+        finally:
+            self._waiting -= 1
+
+    def _handle(self, path):
+        f = self._handles.get(path)
+        if f is not None:
+            self._handles.move_to_end(path)
+            return f
+        while len(self._handles) >= self.max_open_files:
+            old_path, old = self._handles.popitem(last=False)
+            self._close_handle(old_path, old)
+        f = path.open("a", encoding="utf-8")
+        self._handles[path] = f
+        return f
+
+    def _close_handle(self, path, f):
+        try:
+            if path in self._dirty and self.fsync != "none":
+                f.flush()
+                os.fsync(f.fileno())
+                self._stats["fsyncs"] += 1
+            f.close()
+        except OSError as e:
+            self._stats["errors"] += 1
+            LOG_WRITE_ERRORS.inc()
+            print(f"[logger] failed to close {path}: {e}", file=sys.stderr, flush=True)
+        self._dirty.discard(path)
+
+    def _write_segments(self, batch):
+        try:
+            self.segments.append([(pid, line) for pid, line, _ in batch])
+            if self.fsync == "batch":
+                self.segments.sync()
+                self._stats["fsyncs"] += 1
+            self._stats["written"] += len(batch)
+            LOG_RECORDS.inc(len(batch))
+            now = time.perf_counter()
+            for _, _, enqueued_at in batch:
+                LOG_DURABLE_SECONDS.observe(now - enqueued_at)
+        except OSError as e:
+            self._stats["errors"] += 1
+            LOG_WRITE_ERRORS.inc()
+            print(f"[logger] failed to write {len(batch)} records to {self.segments.path}: {e}", file=sys.stderr, flush=True)
+            # Start a new segment rather than appending after a partial write.
+            try:
+                self.segments.close()
+            except OSError as e:
+                print(f"[logger] failed to close {self.segments.path}: {e}", file=sys.stderr, flush=True)
+        self._stats["batches"] += 1
+
+        if self.fsync == "interval" and time.monotonic() - self._last_fsync >= self.fsync_interval:
+            self._sync_dirty()
+
+    def _write_batch(self, batch):
+        if self.segments is not None:
+            return self._write_segments(batch)
+        by_path = {}
+        for path, line, enqueued_at in batch:
+            lines, times = by_path.setdefault(path, ([], []))
+            lines.append(line)
+            times.append(enqueued_at)
+
+        for path, (lines, times) in by_path.items():
+            try:
+                f = self._handle(path)
+                if self.lock:
+                    # Another worker may append to the same pid's file.
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    f.write("\n".join(lines) + "\n")
+                    f.flush()
+                finally:
+                    if self.lock:
+                        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                if self.fsync == "batch":
+                    os.fsync(f.fileno())
+                    self._stats["fsyncs"] += 1
+                else:
+                    self._dirty.add(path)
+                self._stats["written"] += len(lines)
+                LOG_RECORDS.inc(len(lines))
+                now = time.perf_counter()
+                for enqueued_at in times:
+                    LOG_DURABLE_SECONDS.observe(now - enqueued_at)
+            except OSError as e:
+                self._stats["errors"] += 1
+                LOG_WRITE_ERRORS.inc()
+                print(f"[logger] failed to write {len(lines)} records to {path}: {e}", file=sys.stderr, flush=True)
+                stale = self._handles.pop(path, None)
+                if stale is not None:
+                    self._close_handle(path, stale)
+        self._stats["batches"] += 1
 
+        if self.fsync == "interval" and time.monotonic() - self._last_fsync >= self.fsync_interval:
+            self._sync_dirty()
+
+    def _sync_dirty(self):
+        if self.segments is not None and self.segments.dirty:
+            try:
+                self.segments.sync()
+                self._stats["fsyncs"] += 1
+            except OSError as e:
+                self._stats["errors"] += 1
+                LOG_WRITE_ERRORS.inc()
+                print(f"[logger] fsync failed for {self.segments.path}: {e}", file=sys.stderr, flush=True)
+        for path in list(self._dirty):
+            f = self._handles.get(path)
+            if f is None:
+                continue
+            try:
+                os.fsync(f.fileno())
+                self._stats["fsyncs"] += 1
+            except OSError as e:
+                self._stats["errors"] += 1
+                LOG_WRITE_ERRORS.inc()
+                print(f"[logger] fsync failed for {path}: {e}", file=sys.stderr, flush=True)
+        self._dirty.clear()
+        self._last_fsync = time.monotonic()
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.fsync_interval)
+            except queue.Empty:
+                if self.fsync == "interval" and (self._dirty or (self.segments is not None and self.segments.dirty)):
+                    self._sync_dirty()
+                continue
+
+            batch, stop = [], item is _STOP
+            if not stop:
+                batch.append(item)
+            while len(batch) < self.batch_size and not stop:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                else:
+                    batch.append(item)
+
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    # The thread must survive: log_event, flush() and close()
+                    # all wait on it.
+                    self._stats["errors"] += 1
+                    LOG_WRITE_ERRORS.inc()
+                    print(f"[logger] dropped {len(batch)} records: {e.__class__.__name__}: {e}",
+                          file=sys.stderr, flush=True)
+            for _ in range(len(batch) + stop):
+                self._queue.task_done()
+            if stop:
+                break
+
+        for path, f in list(self._handles.items()):
+            self._close_handle(path, f)
+        self._handles.clear()
+        if self.segments is not None:
+            try:
+                self.segments.close()
+            except OSError as e:
+                self._stats["errors"] += 1
+                LOG_WRITE_ERRORS.inc()
+                print(f"[logger] failed to close {self.segments.path}: {e}", file=sys.stderr, flush=True)
+
+    def flush(self):
+        # Blocks until every record queued so far has been written.
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def stats(self) -> dict:
+        return {**self._stats, "queue_depth": self._queue.qsize(), "open_files": len(self._handles)}
+
+if LOG_LAYOUT not in ("per_pid", "segmented"):
+    raise ValueError(f"unknown APP_LOG_LAYOUT {LOG_LAYOUT!r}")
+
+writer = LogWriter(segments=SegmentLog(SEGMENTS_DIR, prefix=f"w{WORKER_ID}" if WORKER_ID else "seg")
+                   if LOG_LAYOUT == "segmented" else None)
+atexit.register(writer.close)
+
+LOG_QUEUE_DEPTH = Gauge("log_writer_queue_depth", "Records waiting for the log writer thread.",
+                        fn=lambda: writer.stats()["queue_depth"])
+
+async def _append_jsonl(path: pathlib.Path, obj: dict):
     line = json.dumps(obj, ensure_ascii=False)
-    def _write():
-        with path.open("a", encoding="utf-8") as f:
-            f.write(line + "\n")
-    await asyncio.to_thread(_write)
+    await writer.put(path, line)
+
+async def flush_logs():
+    await asyncio.to_thread(writer.flush)
 
 async def log_event(pid: str, kind: str, payload: dict):
     record = {
@@ -32,4 +320,15 @@ async def log_event(pid: str, kind: str, payload: dict):
         "kind": kind,
         **payload,
     }
-    await _append_jsonl(_pid_log_path(pid), record)
+    await _append_jsonl(pid if writer.segments is not None else _pid_log_path(pid), record)
+
+def read_events(pid: str) -> list:
+    # Every record logged for pid, oldest first, in either layout. Records
+    # still queued in the writer are not included; call writer.flush() first.
+    if LOG_LAYOUT == "segmented":
+        return SegmentIndex(SEGMENTS_DIR).refresh().read(pid)
+    path = _pid_log_path(pid)
+    if not path.exists():
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
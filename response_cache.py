@@ -0,0 +1,129 @@
+import os
+import asyncio, hashlib, json, re, sqlite3, threading, time, types
+from collections import OrderedDict
+
+from metrics import Counter, Gauge
+
+# Optional cache of complete replies for deterministic (temperature 0)
+# requests, keyed by a hash of the model, the tool settings and the
+# truncated input. Hits are replayed as text deltas paced like a real
+# stream. The request includes web search, so a cached reply can differ from
+# what a live call would return now. The cache is off unless RESPONSE_CACHE=1,
+# and every turn's chat_assistant record says whether it was a hit.
+
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "")
+RESPONSE_CACHE_BUSY_TIMEOUT = float(os.getenv("RESPONSE_CACHE_BUSY_TIMEOUT", "5"))
+# Replay pacing for hits, in chunks (roughly tokens) per second; 0 replays at once.
+RESPONSE_CACHE_REPLAY_TPS = float(os.getenv("RESPONSE_CACHE_REPLAY_TPS", "60"))
+
+KEY_FIELDS = ("model", "temperature", "tools", "tool_choice", "parallel_tool_calls")
+
+CACHE_LOOKUPS = Counter("response_cache_lookups_total", "Response cache lookups by result.", ["result"])
+CACHE_STORES = Counter("response_cache_stores_total", "Replies added to the response cache.")
+
+_chunk_re = re.compile(r"\S+\s*|\s+")
+
+def cacheable(request):
+    return request.get("temperature") == 0
+
+def cache_key(request):
+    # Whitespace inside messages is collapsed so formatting-only differences
+    # share an entry; everything else must match exactly.
+    canonical = {name: request.get(name) for name in KEY_FIELDS}
+    canonical["input"] = [{"role": m["role"], "content": " ".join(str(m["content"]).split())}
+                          for m in request["input"]]
+    data = json.dumps(canonical, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+async def replay_events(text, tokens_per_sec=RESPONSE_CACHE_REPLAY_TPS):
+    # Mimics the Responses stream's text deltas, one word-sized chunk at a time.
+    interval = 1 / tokens_per_sec if tokens_per_sec > 0 else 0
+    for chunk in _chunk_re.findall(text):
+        yield types.SimpleNamespace(type="response.output_text.delta", delta=chunk)
+        if interval:
+            await asyncio.sleep(interval)
+
+class ResponseCache:
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, path=RESPONSE_CACHE_PATH):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()   # key -> (text, created)
+        self._db = None
+        self._db_lock = threading.Lock()
+        if path:
+            # Several app workers (serve.py) may share the file: WAL lets
+            # readers run alongside a writer, and writers wait for each other.
+            self._db = sqlite3.connect(path, timeout=RESPONSE_CACHE_BUSY_TIMEOUT, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, text TEXT, created REAL)")
+            self._db.execute("DELETE FROM responses WHERE created < ?", (time.time() - ttl,))
+            self._db.commit()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remember(self, key, text, created):
+        self._entries[key] = (text, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _load(self, key):
+        # A database error counts as a miss.
+        with self._db_lock:
+            try:
+                return self._db.execute("SELECT text, created FROM responses WHERE key = ?", (key,)).fetchone()
+            except sqlite3.Error as e:
+                print(f"[response_cache] lookup failed: {e}", flush=True)
+                return None
+
+    def _store(self, key, text, created):
+        # The reply is already on its way to the participant; a failed write
+        # only loses the cache entry on disk.
+        with self._db_lock:
+            try:
+                self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, text, created))
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"[response_cache] store failed: {e}", flush=True)
+                try:
+                    self._db.rollback()
+                except sqlite3.Error:
+                    pass
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None and self._db is not None:
+            entry = await asyncio.to_thread(self._load, key)
+            if entry is not None:
+                self._remember(key, *entry)
+        if entry is not None and time.time() - entry[1] > self.ttl:
+            self._entries.pop(key, None)
+            entry = None
+        CACHE_LOOKUPS.inc(result="hit" if entry is not None else "miss")
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    async def put(self, key, text):
+        if not text:
+            return
+        created = time.time()
+        self._remember(key, text, created)
+        CACHE_STORES.inc()
+        if self._db is not None:
+            await asyncio.to_thread(self._store, key, text, created)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": CACHE_LOOKUPS.value(result="hit"),
+                "misses": CACHE_LOOKUPS.value(result="miss")}
+
+cache = ResponseCache() if RESPONSE_CACHE else None
+
+CACHE_ENTRIES = Gauge("response_cache_entries", "Replies held in the in-memory response cache.",
+                      fn=lambda: len(cache) if cache is not None else 0)
@@ -0,0 +1,211 @@
+import os
+import argparse, asyncio, contextlib, hashlib, itertools, pathlib, signal, subprocess, sys, threading, time
+
+# Multi-process serving: runs several app.py workers, each with its own event
+# loop on its own port, behind a local reverse proxy. A participant stays on
+# one worker: the worker is picked from a hash of their pid on the page load
+# (?pid=...) and remembered in a cookie for the Gradio API calls that follow.
+#
+#   python serve.py --workers 4 --port 7860
+#
+# Workers do not open Gradio share links; expose the proxy port instead.
+# GRADIO_CONCURRENCY and UPSTREAM_MAX_INFLIGHT apply per worker (see
+# --concurrency and --upstream-inflight). Logs stay safe with several
+# writers: see WORKER_ID in logger.py.
+
+from tasks import TASK_DRAIN_TIMEOUT
+
+APP_PATH = pathlib.Path(__file__).parent / "app.py"
+APP_WORKERS = int(os.getenv("APP_WORKERS", str(os.cpu_count() or 1)))
+APP_PORT = int(os.getenv("APP_PORT", "7860"))
+APP_WORKER_BASE_PORT = int(os.getenv("APP_WORKER_BASE_PORT", "7870"))
+# How long a worker may take to start answering before the next one is tried.
+APP_WORKER_RESPONSE_TIMEOUT = float(os.getenv("APP_WORKER_RESPONSE_TIMEOUT", "30"))
+
+WORKER_COOKIE = "app_worker"
+# Same query parameters as app.get_params_from_request.
+PID_PARAMS = ("pid", "response_id", "ResponseID", "id")
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailers",
+              "transfer-encoding", "upgrade", "host"}
+
+def worker_for(pid, workers):
+    digest = hashlib.blake2b(pid.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % workers
+
+class Workers:
+    # Starts the worker processes and restarts any that exit until stop().
+
+    def __init__(self, count, base_port, env=None, metrics_base=0):
+        self.ports = [base_port + i for i in range(count)]
+        self.env = env or {}
+        self.metrics_base = metrics_base
+        self._procs = [None] * count
+        self._started = [0.0] * count
+        self._backoff = [1.0] * count
+        self._stopping = threading.Event()
+        self._watcher = threading.Thread(target=self._watch, name="workers", daemon=True)
+
+    def _spawn(self, i):
+        env = dict(os.environ, **self.env,
+                   APP_WORKER_ID=str(i), APP_SHARE="0",
+                   GRADIO_SERVER_NAME="127.0.0.1", GRADIO_SERVER_PORT=str(self.ports[i]),
+                   METRICS_PORT=str(self.metrics_base + i) if self.metrics_base else "0")
+        self._procs[i] = subprocess.Popen([sys.executable, str(APP_PATH)], cwd=APP_PATH.parent, env=env)
+        self._started[i] = time.monotonic()
+        print(f"[serve] worker {i} (pid {self._procs[i].pid}) on port {self.ports[i]}", flush=True)
+
+    def start(self):
+        for i in range(len(self.ports)):
+            self._spawn(i)
+        self._watcher.start()
+        return self
+
+    def _watch(self):
+        while not self._stopping.wait(1.0):
+            for i, proc in enumerate(self._procs):
+                code = proc.poll()
+                if code is None:
+                    continue
+                # Back off when a worker keeps dying during start-up.
+                quick = time.monotonic() - self._started[i] < 30
+                self._backoff[i] = min(30.0, self._backoff[i] * 2) if quick else 1.0
+                print(f"[serve] worker {i} exited with code {code}, restarting in {self._backoff[i]:.0f}s", flush=True)
+                if self._stopping.wait(self._backoff[i]):
+                    return
+                self._spawn(i)
+
+    def stop(self, timeout=TASK_DRAIN_TIMEOUT + 10):
+        # SIGTERM lets each worker drain its turns and log writes first.
+        self._stopping.set()
+        procs = [p for p in self._procs if p is not None and p.poll() is None]
+        for proc in procs:
+            proc.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + timeout
+        for proc in procs:
+            try:
+                proc.wait(max(0.1, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                print(f"[serve] worker pid {proc.pid} did not stop, killing it", flush=True)
+                proc.kill()
+                proc.wait()
+
+def create_proxy(ports):
+    import httpx
+    from starlette.applications import Starlette
+    from starlette.background import BackgroundTask
+    from starlette.responses import JSONResponse, Response, StreamingResponse
+    from starlette.routing import Route
+
+    workers = len(ports)
+    # No read timeout: Gradio streams turns and heartbeats over long-lived SSE responses.
+    clients = [httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=httpx.Timeout(None, connect=5.0),
+                                 limits=httpx.Limits(max_connections=None, max_keepalive_connections=64))
+               for port in ports]
+    next_worker = itertools.count()
+
+    def pick(request):
+        # (worker index, whether to (re)set the cookie)
+        params = request.query_params
+        pid = next((params[name] for name in PID_PARAMS if params.get(name)), None)
+        if pid:
+            return worker_for(pid, workers), True
+        cookie = request.cookies.get(WORKER_COOKIE, "")
+        if cookie.isdigit() and int(cookie) < workers:
+            return int(cookie), False
+        return next(next_worker) % workers, True
+
+    async def forward(request):
+        index, set_cookie = pick(request)
+        headers = [(k, v) for k, v in request.headers.raw if k.decode("latin-1").lower() not in HOP_BY_HOP]
+        headers += [(b"host", request.headers.get("host", "").encode("latin-1")),
+                    (b"x-forwarded-for", (request.client.host if request.client else "").encode("latin-1")),
+                    (b"x-forwarded-proto", request.url.scheme.encode("latin-1"))]
+        url = request.url.path + (f"?{request.url.query}" if request.url.query else "")
+        # Gradio's request bodies are small JSON, so buffering allows a retry.
+        body = await request.body()
+        for attempt in range(workers):
+            # A worker that is down, restarting or not answering hands its
+            # participants to the next one; their sessions are reseeded there.
+            i = (index + attempt) % workers
+            upstream_request = clients[i].build_request(request.method, url, headers=headers, content=body)
+            try:
+                upstream = await asyncio.wait_for(clients[i].send(upstream_request, stream=True),
+                                                  APP_WORKER_RESPONSE_TIMEOUT)
+            except (httpx.TransportError, asyncio.TimeoutError) as e:
+                print(f"[serve] worker {i} failed ({e.__class__.__name__}), trying the next one", flush=True)
+                continue
+            response = StreamingResponse(upstream.aiter_raw(), status_code=upstream.status_code,
+                                         background=BackgroundTask(upstream.aclose))
+            response.raw_headers = [(k, v) for k, v in upstream.headers.raw
+                                    if k.decode("latin-1").lower() not in HOP_BY_HOP]
+            if set_cookie or i != index:
+                response.set_cookie(WORKER_COOKIE, str(i), httponly=True, samesite="lax")
+            return response
+        return Response("no app worker is reachable", status_code=502)
+
+    async def ready(request):
+        # Ready when every worker is.
+        async def one(client):
+            try:
+                r = await client.get("/ready", timeout=2.0)
+                return r.status_code == 200, r.json()
+            except (httpx.HTTPError, ValueError) as e:
+                return False, {"ready": False, "error": f"{e.__class__.__name__}: {e}"}
+
+        results = await asyncio.gather(*[one(c) for c in clients])
+        body = {"ready": all(ok for ok, _ in results), "workers": [snapshot for _, snapshot in results]}
+        return JSONResponse(body, status_code=200 if body["ready"] else 503)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        yield
+        await asyncio.gather(*[c.aclose() for c in clients])
+
+    methods = ["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"]
+    return Starlette(routes=[
+        Route("/ready", ready, methods=["GET"]),
+        Route("/{path:path}", forward, methods=methods),
+    ], lifespan=lifespan)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve app.py from several worker processes behind a sticky proxy.")
+    parser.add_argument("--workers", type=int, default=APP_WORKERS, help="worker processes (default: CPU count)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=APP_PORT)
+    parser.add_argument("--worker-base-port", type=int, default=APP_WORKER_BASE_PORT)
+    parser.add_argument("--concurrency", type=int, default=None, help="GRADIO_CONCURRENCY for each worker")
+    parser.add_argument("--upstream-inflight", type=int, default=None,
+                        help="total upstream streams, split evenly across the workers")
+    parser.add_argument("--metrics-base-port", type=int, default=int(os.getenv("METRICS_PORT", "9100")),
+                        help="worker i serves metrics on this port + i (0 disables)")
+    args = parser.parse_args(argv)
+
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit("serve.py needs uvicorn: pip install uvicorn")
+
+    env = {}
+    if args.concurrency is not None:
+        env["GRADIO_CONCURRENCY"] = str(args.concurrency)
+    if args.upstream_inflight is not None:
+        env["UPSTREAM_MAX_INFLIGHT"] = str(max(1, args.upstream_inflight // args.workers))
+
+    # uvicorn shuts down on SIGTERM and then re-raises it; turn it into a
+    # KeyboardInterrupt so the workers are still stopped below.
+    def _on_sigterm(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, _on_sigterm)
+    workers = Workers(args.workers, args.worker_base_port, env, args.metrics_base_port).start()
+    print(f"[serve] proxy on http://{args.host}:{args.port} for {args.workers} workers", flush=True)
+    try:
+        uvicorn.run(create_proxy(workers.ports), host=args.host, port=args.port, log_level="warning")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("[serve] stopping workers", flush=True)
+        workers.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import os
+import time, uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from chat_helpers import INPUT_ROLES
+from metrics import Counter, Gauge
+
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", str(3 * 3600)))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(512 * 1024 * 1024)))
+# Sessions active within this many seconds are never evicted for memory.
+SESSION_EVICT_MIN_IDLE = float(os.getenv("SESSION_EVICT_MIN_IDLE", str(30 * 60)))
+
+# Rough per-message bookkeeping cost on top of the text itself.
+MESSAGE_OVERHEAD = 200
+
+SESSIONS_EVICTED = Counter("sessions_evicted_total", "Chat sessions evicted from the store.", ["reason"])
+
+@dataclass
+class Session:
+    key: str
+    pid: str
+    q: str
+    ant: str
+    correct: str
+    messages: list = field(default_factory=list)
+    token_counts: list = field(default_factory=list)
+    # The history's upstream input and token counts, kept up to date so a
+    # turn only appends its own message (see build_input_from_history).
+    input_parts: list = field(default_factory=list)
+    input_counts: list = field(default_factory=list)
+    nbytes: int = 0
+    last_seen: float = 0.0
+    turn: object = field(default=None, repr=False, compare=False)   # app.Turn in progress
+
+    @property
+    def prefix(self):
+        return self.input_parts, self.input_counts
+
+    def visible_messages(self):
+        # What the Chatbot shows: everything except the seeded system prompt.
+        return [{"role": m["role"], "content": m["content"]} for m in self.messages if m["role"] != "system"]
+
+class SessionStore:
+    # Server-side chat history keyed by the Gradio session, so the browser
+    # only sends the new message each turn. Sessions idle for longer than
+    # idle_ttl are evicted, and the least recently used ones go first once
+    # the store holds more than max_bytes of text. Memory eviction spares
+    # sessions active within min_idle, even if the store stays over max_bytes.
+
+    def __init__(self, idle_ttl=SESSION_IDLE_TTL, max_bytes=SESSION_MAX_BYTES, min_idle=SESSION_EVICT_MIN_IDLE):
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_bytes
+        self.min_idle = min_idle
+        self._sessions = OrderedDict()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def create(self, key, pid, q, ant, correct, messages, token_counts):
+        key = key or uuid.uuid4().hex
+        self.drop(key)
+        session = Session(key, pid, q, ant, correct)
+        for message, tokens in zip(messages, token_counts):
+            self._append(session, message["role"], message["content"], tokens)
+        session.last_seen = time.monotonic()
+        self._sessions[key] = session
+        self._bytes += session.nbytes
+        self.evict()
+        return session
+
+    def get(self, key):
+        session = self._sessions.get(key)
+        if session is None:
+            return None
+        session.last_seen = time.monotonic()
+        self._sessions.move_to_end(key)
+        return session
+
+    def _append(self, session, role, content, tokens):
+        session.messages.append({"role": role, "content": content})
+        session.token_counts.append(tokens)
+        if role in INPUT_ROLES:
+            session.input_parts.append({"role": role, "content": content})
+            session.input_counts.append(tokens)
+        size = len(content) + MESSAGE_OVERHEAD
+        session.nbytes += size
+        return size
+
+    def append(self, session, role, content, tokens):
+        size = self._append(session, role, content, tokens)
+        if session.key in self._sessions:
+            self._bytes += size
+        self.evict()
+
+    def drop(self, key):
+        session = self._sessions.pop(key, None)
+        if session is not None:
+            self._bytes -= session.nbytes
+        return session
+
+    def evict(self, now=None):
+        now = time.monotonic() if now is None else now
+        while self._sessions:
+            key, oldest = next(iter(self._sessions.items()))
+            if now - oldest.last_seen > self.idle_ttl:
+                reason = "idle"
+            elif (self._bytes > self.max_bytes and len(self._sessions) > 1
+                  and now - oldest.last_seen > self.min_idle):
+                reason = "memory"
+            else:
+                break
+            self.drop(key)
+            SESSIONS_EVICTED.inc(reason=reason)
+
+    def stats(self) -> dict:
+        return {"sessions": len(self._sessions), "bytes": self._bytes}
+
+store = SessionStore()
+
+SESSIONS_ACTIVE = Gauge("sessions_active", "Chat sessions held in the server-side store.",
+                        fn=lambda: len(store))
+SESSIONS_BYTES = Gauge("sessions_bytes", "Approximate size of the server-side session store.",
+                       fn=lambda: store.stats()["bytes"])
@@ -0,0 +1,89 @@
+import os
+import asyncio, sys
+
+from metrics import Counter, Gauge
+
+TASK_MAX_CONCURRENCY = int(os.getenv("TASK_MAX_CONCURRENCY", "64"))
+TASK_DRAIN_TIMEOUT = float(os.getenv("TASK_DRAIN_TIMEOUT", "10"))
+
+TASK_ERRORS = Counter("background_task_errors_total", "Supervised background tasks that raised.", ["name"])
+TASKS_CANCELLED = Counter("background_tasks_cancelled_total", "Supervised background tasks cancelled at shutdown.")
+
+class TaskSupervisor:
+    # Holds a reference to every fire-and-forget task so none is garbage
+    # collected mid-flight, logs their failures, and waits for them on
+    # shutdown. Bounded tasks (log writes etc.) run at most max_concurrency
+    # at a time; unbounded ones (upstream streams) are admitted elsewhere.
+
+    def __init__(self, max_concurrency=TASK_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self._tasks = set()
+        self._sem = None
+        self._loop = None
+        self._closing = False
+
+    def __len__(self):
+        return len(self._tasks)
+
+    async def _bounded(self, coro):
+        async with self._sem:
+            return await coro
+
+    def spawn(self, coro, name="task", bounded=True):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._sem = asyncio.Semaphore(self.max_concurrency)
+        if bounded:
+            coro = self._bounded(coro)
+        task = loop.create_task(coro, name=name)
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task):
+        self._tasks.discard(task)
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            TASK_ERRORS.inc(name=task.get_name())
+            print(f"[tasks] {task.get_name()} failed: {exc.__class__.__name__}: {exc}", file=sys.stderr, flush=True)
+
+    async def drain(self, timeout=TASK_DRAIN_TIMEOUT):
+        # Waits for every task (including ones spawned while draining) up to
+        # timeout seconds, then cancels whatever is left.
+        self._closing = True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self._tasks:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            await asyncio.wait(list(self._tasks), timeout=remaining)
+        stragglers = list(self._tasks)
+        for task in stragglers:
+            task.cancel()
+        if stragglers:
+            TASKS_CANCELLED.inc(len(stragglers))
+            print(f"[tasks] cancelled {len(stragglers)} tasks still running after {timeout:.0f}s", flush=True)
+            await asyncio.wait(stragglers, timeout=1.0)
+
+    def drain_threadsafe(self, timeout=TASK_DRAIN_TIMEOUT):
+        # For shutdown code running outside the event loop thread.
+        loop = self._loop
+        if loop is None or loop.is_closed() or not loop.is_running():
+            return
+        future = asyncio.run_coroutine_threadsafe(self.drain(timeout), loop)
+        try:
+            future.result(timeout + 2)
+        except Exception as e:
+            print(f"[tasks] drain failed: {e.__class__.__name__}: {e}", file=sys.stderr, flush=True)
+
+    def stats(self) -> dict:
+        return {"tasks": len(self._tasks), "closing": self._closing}
+
+supervisor = TaskSupervisor()
+
+BACKGROUND_TASKS = Gauge("background_tasks", "Supervised background tasks pending or running.",
+                         fn=lambda: len(supervisor))
@@ -0,0 +1,8 @@
+import os, sys, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The app modules live at the repository root, the collector's next to it.
+sys.path[:0] = [ROOT, os.path.join(ROOT, "QualtricsTracker")]
+
+# logger.py creates APP_DATA_DIR on import; keep test runs out of ./user_data.
+os.environ.setdefault("APP_DATA_DIR", tempfile.mkdtemp(prefix="test_user_data_"))
@@ -0,0 +1,32 @@
+import chat_helpers
+from chat_helpers import build_input_from_history, load_scenario_registry, truncate_history
+
+def _counts(messages):
+    return [len(m["content"]) for m in messages]
+
+def test_scenarios_load_outside_the_repo_root(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(chat_helpers, "count_text_tokens", lambda text, model="gpt-4.1": len(text.split()))
+    registry = load_scenario_registry()
+    scenario = registry.get("Q1", True, False)
+    assert [role for role, _ in scenario.messages][:2] == ["system", "user"]
+    assert len(scenario.token_counts) == len(scenario.messages)
+
+def test_truncate_keeps_first_and_latest_messages():
+    messages = [{"role": "user", "content": "x" * n} for n in (5, 10, 10, 10, 4)]
+    kept = truncate_history(list(messages), max_tokens=20, counts=_counts(messages))
+    assert [len(m["content"]) for m in kept] == [5, 10, 4]
+    # Never fewer than two messages, even over the limit.
+    kept = truncate_history(list(messages), max_tokens=1, counts=_counts(messages))
+    assert [len(m["content"]) for m in kept] == [5, 4]
+
+def test_build_input_with_prefix_matches_history(monkeypatch):
+    monkeypatch.setattr(chat_helpers, "count_text_tokens", lambda text, model="gpt-4.1": len(text))
+    history = [{"role": "system", "content": "sys"}, {"role": "user", "content": "hi"},
+               {"role": "assistant", "content": "hello"}]
+    counts = [3, 2, 5]
+    prefix = ([{"role": m["role"], "content": m["content"]} for m in history[1:]], counts[1:])
+    assert (build_input_from_history("next", history, counts, prefix)
+            == build_input_from_history("next", history, counts)
+            == [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"},
+                {"role": "user", "content": "next"}])
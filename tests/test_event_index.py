@@ -0,0 +1,73 @@
+import sqlite3
+
+from event_index import EventIndex
+from snapshot_store import SnapshotStore
+
+def _ev(log_id, url, question_id=None, source=None):
+    return {"logId": log_id, "url": url, "questionId": question_id, "source": source, "ts": "2025-01-01T00:00:00Z"}
+
+def _store(tmp_path):
+    index = EventIndex(str(tmp_path / "index.sqlite"), str(tmp_path))
+    return SnapshotStore(str(tmp_path), compact_delay=3600, index=index), index
+
+def test_missing_fields_group_together_before_and_after_compaction(tmp_path):
+    store, index = _store(tmp_path)
+    try:
+        store.append("r1", [_ev("a", "https://www.google.com/search?q=x"), _ev("b", "https://example.com/")])
+        store.append("r2", [_ev("c", "https://example.com/", "Q1", "popup")])
+        before = index.questions()
+        assert [q["question_id"] for q in before] == ["", "Q1"]
+        assert before[0]["events"] == 2 and before[0]["search_events"] == 1
+
+        # Drops "b": tombstoned in the index, then compacted out of the CSV.
+        store.sync("r1", [_ev("a", "https://www.google.com/search?q=x"), _ev("d", "https://example.org/")])
+        assert store.compact("r1") == 1
+        after = index.questions()
+        assert [q["question_id"] for q in after] == ["", "Q1"]
+        assert after[0]["events"] == 2 and after[0]["responses"] == 1
+        assert {s["source"] for s in index.sources()} == {"", "popup"}
+        assert [e["url"] for e in index.events("r1")] == ["https://www.google.com/search?q=x", "https://example.org/"]
+    finally:
+        store.close()
+        index.close()
+
+def test_reconcile_matches_incremental_updates(tmp_path):
+    store, index = _store(tmp_path)
+    try:
+        store.append("r1", [_ev("a", "https://example.com/", "Q2"), _ev("b", "https://example.com/")])
+        store.sync("r1", [_ev("b", "https://example.com/")])
+        incremental = index.questions()
+    finally:
+        store.close()
+        index.close()
+
+    fresh = EventIndex(str(tmp_path / "fresh.sqlite"), str(tmp_path))
+    store = SnapshotStore(str(tmp_path), compact_delay=3600)
+    try:
+        fresh.reconcile(store.lock)
+        assert fresh.questions() == incremental
+    finally:
+        store.close()
+        fresh.close()
+
+def test_failed_update_is_dirty_until_repaired(tmp_path):
+    store, index = _store(tmp_path)
+    try:
+        store.append("r1", [_ev("a", "https://example.com/", "Q1")])
+
+        def fail(db):
+            raise sqlite3.OperationalError("database is locked")
+
+        with store.lock("r1"):
+            index._write("r1", fail)
+        assert index.dirty()
+        # The CSV got a row the index missed.
+        with open(tmp_path / "r1.csv", "a", encoding="utf-8") as f:
+            f.write("2025-01-01T00:00:01Z,https://example.org/,Q1,,,b\n")
+
+        assert index.repair(store.lock) == 0
+        assert not index.dirty()
+        assert [e["log_id"] for e in index.events("r1")] == ["a", "b"]
+    finally:
+        store.close()
+        index.close()
@@ -0,0 +1,65 @@
+import csv, json
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from export import load_events, run_export
+from snapshot_store import HEADER
+
+def _write_tracker(tracker_dir, rid, rows):
+    with open(tracker_dir / f"{rid}.csv", "a", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        if f.tell() == 0:
+            w.writerow(HEADER)
+        w.writerows(rows)
+
+def _write_chat(data_dir, pid, records):
+    with open(data_dir / f"{pid}.jsonl", "a", encoding="utf-8") as f:
+        for rec in records:
+            f.write(json.dumps(dict(rec, pid=pid)) + "\n")
+
+def _tracker_rows(out_dir):
+    table = load_events(out_dir)
+    return sorted((r["pid"], r["url"], r["ant"], r["correct"])
+                  for r in table.to_pylist() if r["origin"] == "tracker")
+
+@pytest.fixture
+def dirs(tmp_path):
+    data_dir, tracker_dir, out_dir = tmp_path / "data", tmp_path / "tracker", tmp_path / "out"
+    data_dir.mkdir()
+    tracker_dir.mkdir()
+    return data_dir, tracker_dir, out_dir
+
+def test_tracker_rows_joined_to_chat_conditions(dirs):
+    data_dir, tracker_dir, out_dir = dirs
+    _write_chat(data_dir, "p1", [{"ts": "2025-01-01T00:00:00Z", "kind": "chat_user", "q": "Q1", "ant": True, "correct": "0"}])
+    _write_tracker(tracker_dir, "p1", [["2025-01-01T00:00:01Z", "https://a/", "Q1", "", "", "a"]])
+    run_export(data_dir, tracker_dir, out_dir)
+    assert _tracker_rows(out_dir) == [("p1", "https://a/", True, False)]
+
+def test_tracker_exported_before_chat_is_backfilled(dirs):
+    data_dir, tracker_dir, out_dir = dirs
+    _write_tracker(tracker_dir, "p1", [["2025-01-01T00:00:01Z", "https://a/", "Q1", "", "", "a"]])
+    _write_tracker(tracker_dir, "p2", [["2025-01-01T00:00:01Z", "https://b/", "Q1", "", "", "b"]])
+    run_export(data_dir, tracker_dir, out_dir)
+    assert _tracker_rows(out_dir) == [("p1", "https://a/", None, None), ("p2", "https://b/", None, None)]
+
+    _write_chat(data_dir, "p1", [{"ts": "2025-01-01T00:00:00Z", "kind": "chat_user", "q": "Q1", "ant": "1", "correct": "1"}])
+    stats = run_export(data_dir, tracker_dir, out_dir)
+    assert stats["regenerated"] == 1
+    assert _tracker_rows(out_dir) == [("p1", "https://a/", True, True), ("p2", "https://b/", None, None)]
+
+    # Known conditions repeated in later chat records change nothing.
+    _write_chat(data_dir, "p1", [{"ts": "2025-01-01T00:00:02Z", "kind": "chat_user", "q": "Q1", "ant": "1", "correct": "1"}])
+    assert run_export(data_dir, tracker_dir, out_dir)["regenerated"] == 0
+    assert _tracker_rows(out_dir) == [("p1", "https://a/", True, True), ("p2", "https://b/", None, None)]
+
+def test_rerun_reads_only_appended_rows(dirs):
+    data_dir, tracker_dir, out_dir = dirs
+    _write_chat(data_dir, "p1", [{"ts": "2025-01-01T00:00:00Z", "kind": "chat_user", "q": "Q1", "ant": "0", "correct": "1"}])
+    assert run_export(data_dir, tracker_dir, out_dir)["rows"] == 1
+    assert run_export(data_dir, tracker_dir, out_dir)["rows"] == 0
+    _write_chat(data_dir, "p1", [{"ts": "2025-01-01T00:00:01Z", "kind": "chat_assistant", "q": "Q1"}])
+    assert run_export(data_dir, tracker_dir, out_dir)["rows"] == 1
+    assert load_events(out_dir).num_rows == 2
@@ -0,0 +1,73 @@
+import json
+
+from log_segments import SegmentIndex, SegmentLog, chat_log_files, index_path, migrate, reindex
+
+def _rec(pid, n, second):
+    return pid, json.dumps({"pid": pid, "n": n, "ts": f"2025-01-01T00:00:{second:02d}Z"})
+
+def test_index_is_incremental(tmp_path):
+    log = SegmentLog(tmp_path)
+    log.append([_rec("a", 0, 0), _rec("b", 1, 1)])
+    index = SegmentIndex(tmp_path).refresh()
+    assert [r["n"] for r in index.read("a")] == [0]
+    log.append([_rec("a", 2, 2)])
+    assert [r["n"] for r in index.refresh().read("a")] == [0, 2]
+    log.close()
+
+def test_new_writer_never_appends_to_an_old_segment(tmp_path):
+    first = SegmentLog(tmp_path)
+    first.append([_rec("a", 0, 0)])
+    first.close()
+    second = SegmentLog(tmp_path)
+    second.append([_rec("a", 1, 1)])
+    second.close()
+    assert sorted(p.name for p in tmp_path.glob("*.jsonl")) == ["seg-00000001.jsonl", "seg-00000002.jsonl"]
+    assert [r["n"] for r in SegmentIndex(tmp_path).refresh().read("a")] == [0, 1]
+
+def test_reindex_rebuilds_missing_and_short_indexes(tmp_path):
+    log = SegmentLog(tmp_path)
+    log.append([_rec("a", 0, 0), _rec("b", 1, 1)])
+    log.append([_rec("a", 2, 2)])
+    log.close()
+    segment = tmp_path / "seg-00000001.jsonl"
+    idx = index_path(segment)
+    # An index line lost in a crash: the last record is not indexed.
+    idx.write_text("".join(idx.read_text().splitlines(keepends=True)[:2]))
+    assert [r["n"] for r in SegmentIndex(tmp_path).refresh().read("a")] == [0]
+    assert reindex(tmp_path) == 1
+    assert [r["n"] for r in SegmentIndex(tmp_path).refresh().read("a")] == [0, 2]
+    idx.unlink()
+    assert reindex(tmp_path) == 1
+    assert [r["n"] for r in SegmentIndex(tmp_path).refresh().read("b")] == [1]
+
+def test_records_from_several_writers_come_back_in_time_order(tmp_path):
+    w1, w2 = SegmentLog(tmp_path, prefix="w1"), SegmentLog(tmp_path, prefix="w2")
+    w2.append([_rec("a", 1, 1)])
+    w1.append([_rec("a", 0, 0), _rec("a", 2, 2)])
+    w2.append([_rec("a", 3, 3)])
+    w1.close()
+    w2.close()
+    assert [r["n"] for r in SegmentIndex(tmp_path).refresh().read("a")] == [0, 1, 2, 3]
+
+def test_migrate_without_remove_is_read_once(tmp_path):
+    for pid in ("P1", "p2"):
+        (tmp_path / f"{pid.lower()}.jsonl").write_text("".join(_rec(pid, i, i)[1] + "\n" for i in range(3)))
+    root = tmp_path / "segments"
+    assert migrate(tmp_path, root) == (2, 6)
+    # A second run skips files listed in the manifest.
+    assert migrate(tmp_path, root) == (0, 0)
+    assert [r["n"] for r in SegmentIndex(root).refresh().read("P1")] == [0, 1, 2]
+
+    def records():
+        out = []
+        for path, skip in chat_log_files(tmp_path):
+            for line in path.read_text().splitlines():
+                rec = json.loads(line)
+                if skip is None or not skip(rec):
+                    out.append((rec["pid"], rec["n"]))
+        return sorted(out)
+
+    expected = sorted((pid, n) for pid in ("P1", "p2") for n in range(3))
+    assert records() == expected
+    (tmp_path / "p1.jsonl").unlink()
+    assert records() == expected
@@ -0,0 +1,73 @@
+import asyncio, json
+
+from log_segments import SegmentIndex, SegmentLog
+from logger import LogWriter
+
+def _lines(path):
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+def _put_all(writer, items):
+    async def run():
+        for path, rec in items:
+            await writer.put(path, json.dumps(rec))
+    asyncio.run(run())
+
+def test_records_keep_their_order_per_file(tmp_path):
+    writer = LogWriter(batch_size=3, fsync="none")
+    paths = [tmp_path / "a.jsonl", tmp_path / "b.jsonl"]
+    _put_all(writer, [(paths[i % 2], {"n": i}) for i in range(50)])
+    writer.close()
+    assert [r["n"] for r in _lines(paths[0])] == list(range(0, 50, 2))
+    assert [r["n"] for r in _lines(paths[1])] == list(range(1, 50, 2))
+    assert writer.stats()["written"] == 50
+
+def test_full_queue_blocks_without_reordering(tmp_path):
+    writer = LogWriter(queue_size=2, batch_size=1, fsync="batch")
+    path = tmp_path / "a.jsonl"
+    _put_all(writer, [(path, {"n": i}) for i in range(30)])
+    writer.flush()
+    assert [r["n"] for r in _lines(path)] == list(range(30))
+    stats = writer.stats()
+    assert stats["blocked_puts"] > 0 and stats["max_queue_depth"] <= 2
+    writer.close()
+
+def test_failed_write_does_not_stop_the_writer(tmp_path):
+    writer = LogWriter(fsync="none", max_open_files=1)
+    bad = tmp_path / "missing" / "a.jsonl"   # parent does not exist
+    good = tmp_path / "b.jsonl"
+    _put_all(writer, [(bad, {"n": 0})])
+    writer.flush()
+    _put_all(writer, [(good, {"n": 1})])
+    writer.close()
+    assert [r["n"] for r in _lines(good)] == [1]
+    assert writer.stats()["errors"] == 1
+
+def test_segmented_layout_reads_back_per_pid(tmp_path):
+    writer = LogWriter(batch_size=4, fsync="interval", segments=SegmentLog(tmp_path, max_bytes=200))
+    _put_all(writer, [(f"p{i % 3}", {"pid": f"p{i % 3}", "n": i, "ts": f"2025-01-01T00:00:{i:02d}Z"})
+                      for i in range(30)])
+    writer.close()
+    index = SegmentIndex(tmp_path).refresh()
+    assert sorted(index.pids()) == ["p0", "p1", "p2"]
+    assert [r["n"] for r in index.read("p1")] == list(range(1, 30, 3))
+    # max_bytes forced rotations.
+    assert len(list(tmp_path.glob("seg-*.jsonl"))) > 1
+
+def test_segment_write_failure_starts_a_new_segment(tmp_path, monkeypatch):
+    segments = SegmentLog(tmp_path)
+    writer = LogWriter(batch_size=1, fsync="none", segments=segments)
+    append = segments.append
+    calls = []
+
+    def flaky(records):
+        calls.append(records)
+        if len(calls) == 2:
+            raise OSError(28, "No space left on device")
+        append(records)
+
+    monkeypatch.setattr(segments, "append", flaky)
+    _put_all(writer, [("p", {"pid": "p", "n": i, "ts": f"2025-01-01T00:00:{i:02d}Z"}) for i in range(3)])
+    writer.close()
+    assert [r["n"] for r in SegmentIndex(tmp_path).refresh().read("p")] == [0, 2]
+    assert len(list(tmp_path.glob("seg-*.jsonl"))) == 2
+    assert writer.stats()["errors"] == 1
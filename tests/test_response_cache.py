@@ -0,0 +1,27 @@
+import asyncio, sqlite3
+
+import response_cache
+from response_cache import ResponseCache
+
+def test_shared_file_survives_a_locked_database(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.sqlite")
+    monkeypatch.setattr(response_cache, "RESPONSE_CACHE_BUSY_TIMEOUT", 0.1)
+    a, b = ResponseCache(path=path), ResponseCache(path=path)
+
+    async def run():
+        await a.put("k1", "first")
+        assert await b.get("k1") == "first"
+
+        other = sqlite3.connect(path)
+        other.execute("BEGIN EXCLUSIVE")
+        try:
+            # Another worker holds the write lock: the reply is still cached
+            # in memory, and lookups elsewhere are misses, not errors.
+            await a.put("k2", "second")
+            assert await a.get("k2") == "second"
+            assert await b.get("k2") is None
+        finally:
+            other.rollback()
+            other.close()
+
+    asyncio.run(run())
@@ -0,0 +1,25 @@
+from sessions import MESSAGE_OVERHEAD, SessionStore
+
+def _create(store, key, size=100):
+    return store.create(key, key, "Q1", "0", "1", [{"role": "user", "content": "x" * size}], [1])
+
+def test_memory_eviction_spares_recent_sessions():
+    store = SessionStore(idle_ttl=3600, max_bytes=2 * (100 + MESSAGE_OVERHEAD), min_idle=60)
+    a, b = _create(store, "a"), _create(store, "b")
+    _create(store, "c")
+    # Over the limit, but every session was active just now.
+    assert len(store) == 3
+
+    a.last_seen -= 120
+    b.last_seen -= 120
+    store.evict()
+    # "a" is the least recently used idle session and goes first.
+    assert store.get("a") is None
+    assert store.get("b") is not None and store.get("c") is not None
+
+def test_idle_sessions_expire():
+    store = SessionStore(idle_ttl=10, max_bytes=1 << 20, min_idle=60)
+    session = _create(store, "a")
+    session.last_seen -= 11
+    store.evict()
+    assert len(store) == 0
@@ -0,0 +1,74 @@
+import csv
+
+from snapshot_store import HEADER, SnapshotStore
+
+def _ev(log_id, url="https://example.com/"):
+    return {"logId": log_id, "url": url, "questionId": "Q1", "ts": "2025-01-01T00:00:00Z"}
+
+def _rows(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.reader(f))
+
+def test_append_skips_stored_log_ids(tmp_path):
+    store = SnapshotStore(str(tmp_path), compact_delay=3600)
+    try:
+        assert store.append("r1", [_ev("a"), _ev("b"), _ev("a")]) == 2
+        assert store.append("r1", [_ev("b"), _ev("c")]) == 1
+        rows = _rows(tmp_path / "r1.csv")
+        assert rows[0] == HEADER
+        assert [r[-1] for r in rows[1:]] == ["a", "b", "c"]
+    finally:
+        store.close()
+
+def test_sync_tombstones_then_compacts(tmp_path):
+    store = SnapshotStore(str(tmp_path), compact_delay=3600)
+    try:
+        store.append("r1", [_ev("a"), _ev("b"), _ev("c")])
+        result = store.sync("r1", [_ev("a"), _ev("c"), _ev("d")])
+        assert result == {"inserted": 1, "deleted": 1, "rewritten": False}
+        # Removed rows stay in the CSV until compaction.
+        assert [r[-1] for r in _rows(tmp_path / "r1.csv")[1:]] == ["a", "b", "c", "d"]
+        assert (tmp_path / "r1.csv.tomb").read_text() == "b\n"
+
+        assert store.compact("r1") == 1
+        assert [r[-1] for r in _rows(tmp_path / "r1.csv")[1:]] == ["a", "c", "d"]
+        assert not (tmp_path / "r1.csv.tomb").exists()
+    finally:
+        store.close()
+
+def test_sync_reorder_rewrites(tmp_path):
+    store = SnapshotStore(str(tmp_path), compact_delay=3600)
+    try:
+        store.append("r1", [_ev("a"), _ev("b")])
+        assert store.sync("r1", [_ev("b"), _ev("a")])["rewritten"]
+        assert [r[-1] for r in _rows(tmp_path / "r1.csv")[1:]] == ["b", "a"]
+    finally:
+        store.close()
+
+def test_tombstones_survive_a_restart(tmp_path):
+    store = SnapshotStore(str(tmp_path), compact_delay=3600)
+    store.append("r1", [_ev("a"), _ev("b")])
+    store.sync("r1", [_ev("a")])
+    store._closed = True   # skip close()'s compaction, as after a crash
+    store = SnapshotStore(str(tmp_path), compact_delay=3600)
+    try:
+        # "b" is still tombstoned, so a resend of it is not stored again.
+        assert store.append("r1", [_ev("b")]) == 0
+        assert store.compact("r1") == 1
+        assert [r[-1] for r in _rows(tmp_path / "r1.csv")[1:]] == ["a"]
+    finally:
+        store.close()
+
+def test_legacy_file_is_backed_up_before_upgrade(tmp_path):
+    legacy = "timestamp_iso,url,question_id,source,search_results\n2025-01-01T00:00:00Z,https://old/,Q1,popup,\n"
+    (tmp_path / "r1.csv").write_text(legacy, encoding="utf-8")
+    store = SnapshotStore(str(tmp_path), compact_delay=3600)
+    try:
+        assert store.append("r1", [_ev("a")]) == 1
+        assert (tmp_path / "r1.csv.bak").read_text(encoding="utf-8") == legacy
+        rows = _rows(tmp_path / "r1.csv")
+        assert rows[0] == HEADER
+        assert rows[1] == ["2025-01-01T00:00:00Z", "https://old/", "Q1", "popup", "", ""]
+        assert rows[2][-1] == "a"
+    finally:
+        store.close()
@@ -0,0 +1,116 @@
+import asyncio, datetime, email.utils
+
+import httpx
+import pytest
+
+from upstream import QueueFull, Scheduler, _retry_after
+
+def _response(**headers):
+    return httpx.Response(429, headers=headers)
+
+def test_retry_after_http_dates():
+    soon = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=30)
+    for value in (email.utils.format_datetime(soon, usegmt=True),
+                  email.utils.format_datetime(soon.replace(tzinfo=None))):  # "... -0000"
+        assert 25 <= _retry_after(_response(**{"retry-after": value})) <= 30
+    past = email.utils.format_datetime(soon - datetime.timedelta(hours=1), usegmt=True)
+    assert _retry_after(_response(**{"retry-after": past})) == 0.0
+
+def test_retry_after_seconds_and_ms():
+    assert _retry_after(_response(**{"retry-after": "2"})) == 2.0
+    assert _retry_after(_response(**{"retry-after-ms": "1500"})) == 1.5
+    assert _retry_after(_response()) is None
+    assert _retry_after(_response(**{"retry-after": "soon"})) is None
+
+def _run(coro):
+    return asyncio.run(coro)
+
+def test_scheduler_caps_inflight_and_per_pid():
+    async def run():
+        s = Scheduler(max_inflight=2, max_per_pid=1, max_queue=10)
+        a1 = s.ticket("a")
+        a2 = s.ticket("a")          # a is at its cap
+        b = s.ticket("b")           # not blocked by a2 waiting ahead of it
+        c = s.ticket("c")           # no slot left
+        assert a1.granted.done() and b.granted.done()
+        assert not a2.granted.done() and not c.granted.done()
+        assert s.position(a2) == 1 and s.position(c) == 2
+
+        b.release()                 # a2 still capped by a1, so c goes first
+        assert c.granted.done() and not a2.granted.done()
+        a1.release()
+        assert a2.granted.done()
+        assert s.stats()["inflight"] == 2
+
+    _run(run())
+
+def test_scheduler_rejects_when_queue_is_full():
+    async def run():
+        s = Scheduler(max_inflight=1, max_per_pid=1, max_queue=1)
+        s.ticket("a")
+        waiting = s.ticket("b")
+        with pytest.raises(QueueFull):
+            s.ticket("c")
+        assert s.stats()["rejected"] == 1
+        # Releasing a ticket that never got a slot just leaves the queue.
+        waiting.release()
+        assert s.stats()["queue_depth"] == 0 and s.stats()["inflight"] == 1
+
+    _run(run())
+
+def test_anon_is_not_capped_per_pid():
+    async def run():
+        s = Scheduler(max_inflight=3, max_per_pid=1)
+        tickets = [s.ticket("anon") for _ in range(3)]
+        assert all(t.granted.done() for t in tickets)
+
+    _run(run())
+
+def test_try_ticket_never_queues():
+    async def run():
+        s = Scheduler(max_inflight=1)
+        t = s.try_ticket()
+        assert t is not None and s.try_ticket() is None
+        waiting = s.ticket("a")
+        t.release()
+        assert waiting.granted.done()
+        assert s.try_ticket() is None and s.stats()["queue_depth"] == 0
+
+    _run(run())
+
+def test_warmer_counts_warm_ups_and_respects_slots(monkeypatch):
+    import upstream
+
+    sent = []
+
+    async def fake_open(client, timeout=0):
+        sent.append(client)
+
+    monkeypatch.setattr(upstream, "open_connection", fake_open)
+
+    async def run():
+        s = Scheduler(max_inflight=2)
+        w = upstream.ConnectionWarmer("client", s, max_idle=4, window=60)
+        assert w.expect("s1") == 1 and w.expect("s2") == 2
+        await w.warm()
+        assert len(sent) == 2 and w.expect("s3") == 1
+        w.forget("s3")
+
+        # Every slot taken by turns: nothing is sent.
+        turns = [s.ticket("a"), s.ticket("b")]
+        w.expect("s4")
+        await w.warm()
+        assert len(sent) == 2
+        for t in turns:
+            t.release()
+
+        # Cancelled before it ran: the warmer is not left busy.
+        task = asyncio.create_task(w.warm())
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await w.warm()
+        assert len(sent) == 3
+        assert s.stats()["inflight"] == 0
+
+    _run(run())
@@ -0,0 +1,316 @@
+import os
+import asyncio, datetime, email.utils, random, time
+from collections import OrderedDict, deque
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, APIStatusError, APIConnectionError
+
+from metrics import Counter, Histogram
+
+UPSTREAM_MAX_INFLIGHT = int(os.getenv("UPSTREAM_MAX_INFLIGHT", "32"))
+UPSTREAM_MAX_PER_PID = int(os.getenv("UPSTREAM_MAX_PER_PID", "1"))
+UPSTREAM_MAX_QUEUE = int(os.getenv("UPSTREAM_MAX_QUEUE", "256"))
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "3"))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.5"))
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", "20"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "10"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "120"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "60"))
+UPSTREAM_PREWARM = os.getenv("UPSTREAM_PREWARM", "0") == "1"
+UPSTREAM_WARM_TIMEOUT = float(os.getenv("UPSTREAM_WARM_TIMEOUT", "10"))
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+UPSTREAM_WAIT_SECONDS = Histogram("upstream_queue_wait_seconds", "Time turns waited for an upstream slot.")
+UPSTREAM_REJECTED = Counter("upstream_rejected_total", "Turns rejected because the upstream queue was full.")
+UPSTREAM_RETRIES = Counter("upstream_retries_total", "Upstream requests retried after an error.")
+UPSTREAM_PREWARMS = Counter("upstream_prewarm_requests_total", "Requests sent to keep connections ready for first turns.")
+
+def make_client():
+    # Retries are handled by respond() so they can honour Retry-After and stop
+    # once text has been streamed to the participant.
+    http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_INFLIGHT + 8,
+            max_keepalive_connections=UPSTREAM_MAX_INFLIGHT,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+    )
+    return AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=http_client,
+        timeout=httpx.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+        max_retries=0,
+    )
+
+def _retry_after(response):
+    if response is None:
+        return None
+    headers = response.headers
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        # "-0000" dates parse as naive; they are UTC.
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+def retry_delay(exc, attempt, max_retries=UPSTREAM_MAX_RETRIES):
+    # Seconds to wait before retrying, or None when exc should not be retried.
+    if attempt >= max_retries:
+        return None
+    if isinstance(exc, APIStatusError):
+        if exc.status_code not in RETRYABLE_STATUS:
+            return None
+        hinted = _retry_after(exc.response)
+    elif isinstance(exc, APIConnectionError):
+        hinted = None
+    else:
+        return None
+
+    if hinted is not None and hinted >= 0:
+        return min(UPSTREAM_BACKOFF_MAX, hinted) + random.uniform(0, UPSTREAM_BACKOFF_BASE)
+    return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * 2 ** attempt))
+
+async def open_connection(client, timeout=UPSTREAM_WARM_TIMEOUT):
+    # Puts one connection (DNS, TCP and TLS done) into the client's pool with
+    # a cheap request. Any HTTP response counts; connection errors raise.
+    try:
+        await client.with_options(timeout=timeout).models.list()
+    except APIStatusError:
+        pass
+
+class ConnectionWarmer:
+    # Tries to have one pooled connection ready per participant who has
+    # started a session but not sent a message yet, so their first turn does
+    # not pay for the connection set-up. Each warm-up is a real (cheap)
+    # upstream request, hence off by default (UPSTREAM_PREWARM).
+    #
+    # The pool itself is not inspected: warm-ups done within the keep-alive
+    # expiry count as warm connections, and only the missing ones are
+    # requested. Sessions older than that window are forgotten too. The count
+    # is an estimate: a warm-up reuses an idle connection if one is free, so
+    # it only adds a connection while turns hold the others. Each
+    # request holds a free scheduler slot, so warming never pushes the
+    # upstream past max_inflight or waits ahead of a turn.
+
+    def __init__(self, client, scheduler, max_idle=UPSTREAM_MAX_INFLIGHT, window=UPSTREAM_KEEPALIVE_EXPIRY):
+        self.client = client
+        self.scheduler = scheduler
+        self.max_idle = max_idle
+        self.window = window
+        self._expecting = OrderedDict()   # session key -> monotonic time
+        self._warmed = deque()            # monotonic times of successful warm-ups
+        self._warming = False
+
+    def _prune(self, now):
+        while self._expecting:
+            key, at = next(iter(self._expecting.items()))
+            if now - at <= self.window:
+                break
+            del self._expecting[key]
+        while self._warmed and now - self._warmed[0] > self.window:
+            self._warmed.popleft()
+
+    def _missing(self, now):
+        self._prune(now)
+        return max(0, min(len(self._expecting), self.max_idle) - len(self._warmed))
+
+    def expect(self, key) -> int:
+        # Records a new session. Returns how many warm-ups are missing; 0
+        # means warm() need not be started.
+        now = time.monotonic()
+        self._expecting[key] = now
+        self._expecting.move_to_end(key)
+        return self._missing(now)
+
+    def forget(self, key):
+        # The session sent its first message or ended.
+        self._expecting.pop(key, None)
+
+    async def warm(self):
+        # One round at a time; a session arriving meanwhile is covered by
+        # the next round. Sends fewer requests if the scheduler is busy.
+        if self._warming:
+            return
+        tickets = []
+        try:
+            self._warming = True
+            n = self._missing(time.monotonic())
+            while len(tickets) < n:
+                ticket = self.scheduler.try_ticket()
+                if ticket is None:
+                    break
+                tickets.append(ticket)
+            if not tickets:
+                return
+            sent = len(tickets)
+            results = await asyncio.gather(*[open_connection(self.client) for _ in tickets], return_exceptions=True)
+            errors = [r for r in results if isinstance(r, BaseException)]
+            now = time.monotonic()
+            self._warmed.extend([now] * (sent - len(errors)))
+            UPSTREAM_PREWARMS.inc(sent - len(errors))
+            if errors:
+                e = errors[0]
+                print(f"[upstream] pre-warm: {len(errors)}/{sent} requests failed: {e.__class__.__name__}: {e}", flush=True)
+        finally:
+            for ticket in tickets:
+                ticket.release()
+            self._warming = False
+
+class QueueFull(Exception):
+    pass
+
+class Ticket:
+
+    def __init__(self, scheduler, pid):
+        self.scheduler = scheduler
+        self.pid = pid
+        self.enqueued_at = time.monotonic()
+        self.granted = asyncio.get_running_loop().create_future()
+        self.released = False
+
+    async def wait(self, interval=1.0):
+        # Yields this ticket's 1-based queue position whenever it changes,
+        # until the ticket is admitted.
+        last = None
+        while not self.granted.done():
+            position = self.scheduler.position(self)
+            if position != last:
+                last = position
+                yield position
+            try:
+                await asyncio.wait_for(asyncio.shield(self.granted), interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.scheduler._release(self)
+
+class Scheduler:
+    # Admission control in front of upstream streams: at most max_inflight
+    # streams overall and max_per_pid per participant. Everyone else waits in
+    # one FIFO queue; a waiter whose pid is at its cap does not block the
+    # waiters behind it.
+
+    def __init__(self, max_inflight=UPSTREAM_MAX_INFLIGHT, max_per_pid=UPSTREAM_MAX_PER_PID,
+                 max_queue=UPSTREAM_MAX_QUEUE):
+        self.max_inflight = max_inflight
+        self.max_per_pid = max_per_pid
+        self.max_queue = max_queue
+        self._waiting = deque()
+        self._inflight = 0
+        self._per_pid = {}
+        self._stats = {
+            "admitted": 0,
+            "rejected": 0,
+            "retries": 0,
+            "wait_seconds_total": 0.0,
+            "max_wait_seconds": 0.0,
+        }
+
+    def _pid_key(self, pid):
+        # "anon" is shared by every participant without a pid, so it is not capped.
+        return None if not pid or pid == "anon" else pid
+
+    def _eligible(self, ticket):
+        if self._inflight >= self.max_inflight:
+            return False
+        key = self._pid_key(ticket.pid)
+        return key is None or self._per_pid.get(key, 0) < self.max_per_pid
+
+    def _grant(self, ticket):
+        self._inflight += 1
+        key = self._pid_key(ticket.pid)
+        if key is not None:
+            self._per_pid[key] = self._per_pid.get(key, 0) + 1
+        waited = time.monotonic() - ticket.enqueued_at
+        self._stats["admitted"] += 1
+        self._stats["wait_seconds_total"] += waited
+        self._stats["max_wait_seconds"] = max(self._stats["max_wait_seconds"], waited)
+        UPSTREAM_WAIT_SECONDS.observe(waited)
+        ticket.granted.set_result(waited)
+
+    def _dispatch(self):
+        if not self._waiting or self._inflight >= self.max_inflight:
+            return
+        for ticket in list(self._waiting):
+            if self._inflight >= self.max_inflight:
+                break
+            if self._eligible(ticket):
+                self._waiting.remove(ticket)
+                self._grant(ticket)
+
+    def ticket(self, pid) -> Ticket:
+        ticket = Ticket(self, pid)
+        # Every release dispatches, so nobody still waiting could use a free
+        # slot: those waiters are at their pid cap and must not block this one.
+        if self._eligible(ticket):
+            self._grant(ticket)
+            return ticket
+        if len(self._waiting) >= self.max_queue:
+            self._stats["rejected"] += 1
+            UPSTREAM_REJECTED.inc()
+            raise QueueFull(f"upstream queue is full ({self.max_queue} waiting)")
+        self._waiting.append(ticket)
+        return ticket
+
+    def try_ticket(self, pid=None):
+        # A granted ticket if a slot is free right now and nobody is waiting
+        # for one, else None. Never queues.
+        ticket = Ticket(self, pid)
+        if self._waiting or not self._eligible(ticket):
+            return None
+        self._grant(ticket)
+        return ticket
+
+    def position(self, ticket):
+        for i, t in enumerate(self._waiting, 1):
+            if t is ticket:
+                return i
+        return 0
+
+    def _release(self, ticket):
+        if not ticket.granted.done():
+            self._waiting.remove(ticket)
+            ticket.granted.cancel()
+            return
+        self._inflight -= 1
+        key = self._pid_key(ticket.pid)
+        if key is not None:
+            left = self._per_pid[key] - 1
+            if left:
+                self._per_pid[key] = left
+            else:
+                del self._per_pid[key]
+        self._dispatch()
+
+    def record_retry(self):
+        self._stats["retries"] += 1
+        UPSTREAM_RETRIES.inc()
+
+    def stats(self) -> dict:
+        admitted = self._stats["admitted"]
+        return {
+            **self._stats,
+            "inflight": self._inflight,
+            "queue_depth": len(self._waiting),
+            "mean_wait_seconds": self._stats["wait_seconds_total"] / admitted if admitted else 0.0,
+        }
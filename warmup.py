@@ -0,0 +1,126 @@
+import os
+import argparse, asyncio, json, pathlib, sys, threading, time
+
+# Startup warm-up: loads the tiktoken encoders and the scenario registry
+# before the app takes traffic, opens a few upstream connections, and tracks
+# which steps are done for the /ready probe.
+#
+# tiktoken keeps its BPE tables in TIKTOKEN_CACHE_DIR. If that is not set,
+# APP_TIKTOKEN_CACHE (default ./tiktoken_cache) is used when it exists, so a
+# deploy can ship the tables and start on a host without network access.
+# Populate the directory on a machine that has network access with:
+#
+#   python warmup.py --fetch
+
+from metrics import Gauge
+
+APP_TIKTOKEN_CACHE = os.getenv("APP_TIKTOKEN_CACHE", str(pathlib.Path(__file__).parent / "tiktoken_cache"))
+WARM_MODELS = tuple(m for m in os.getenv("WARM_MODELS", "gpt-4.1").split(",") if m)
+UPSTREAM_WARM_CONNECTIONS = int(os.getenv("UPSTREAM_WARM_CONNECTIONS", "4"))
+
+WARMUP_SECONDS = Gauge("app_warmup_seconds", "Duration of each startup warm-up step.", ["step"])
+
+def use_tiktoken_cache(cache_dir=APP_TIKTOKEN_CACHE, create=False):
+    # Must run before the first encoder is loaded.
+    if os.getenv("TIKTOKEN_CACHE_DIR"):
+        return os.environ["TIKTOKEN_CACHE_DIR"]
+    if create:
+        os.makedirs(cache_dir, exist_ok=True)
+    if os.path.isdir(cache_dir):
+        os.environ["TIKTOKEN_CACHE_DIR"] = cache_dir
+        return cache_dir
+    return None
+
+class Readiness:
+    # Steps in `critical` must succeed for the app to be ready; the others
+    # only have to have been attempted (a slow upstream should not take the
+    # app out of rotation).
+
+    def __init__(self, steps=("encoders", "scenarios", "upstream"), critical=("encoders", "scenarios")):
+        self.steps = tuple(steps)
+        self.critical = set(critical)
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def mark(self, step, seconds, error=None):
+        with self._lock:
+            self._results[step] = {"ok": error is None, "seconds": round(seconds, 4), "error": error}
+        WARMUP_SECONDS.set(seconds, step=step)
+
+    @property
+    def ready(self):
+        with self._lock:
+            return all(step in self._results and (self._results[step]["ok"] or step not in self.critical)
+                       for step in self.steps)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            steps = {step: self._results.get(step) for step in self.steps}
+        return {"ready": self.ready, "steps": steps}
+
+    def response(self):
+        # (status, content_type, body), as used by metrics.start_http_server routes.
+        snapshot = self.snapshot()
+        return (200 if snapshot["ready"] else 503), "application/json", json.dumps(snapshot)
+
+readiness = Readiness()
+
+def _step(name, fn):
+    start = time.perf_counter()
+    try:
+        fn()
+    except Exception as e:
+        readiness.mark(name, time.perf_counter() - start, f"{e.__class__.__name__}: {e}")
+        print(f"[warmup] {name} failed: {e.__class__.__name__}: {e}", file=sys.stderr, flush=True)
+        return False
+    seconds = time.perf_counter() - start
+    readiness.mark(name, seconds)
+    print(f"[warmup] {name} ready in {seconds:.2f}s", flush=True)
+    return True
+
+def warm_local(models=WARM_MODELS):
+    # Encoders first: loading the scenarios counts their tokens.
+    from chat_helpers import get_encoder, get_scenario_registry
+
+    def encoders():
+        for model in models:
+            get_encoder(model).encode("warm-up")
+
+    ok = _step("encoders", encoders)
+    ok = _step("scenarios", get_scenario_registry) and ok
+    return ok
+
+async def warm_upstream(client, connections=UPSTREAM_WARM_CONNECTIONS, timeout=None):
+    # Opens `connections` pooled connections. Must run on the event loop that
+    # will serve requests, since the pool belongs to that loop.
+    from upstream import UPSTREAM_WARM_TIMEOUT, open_connection
+
+    timeout = timeout or UPSTREAM_WARM_TIMEOUT
+    start = time.perf_counter()
+    results = await asyncio.gather(*[open_connection(client, timeout) for _ in range(max(1, connections))],
+                                   return_exceptions=True)
+    errors = [r for r in results if isinstance(r, BaseException)]
+    seconds = time.perf_counter() - start
+    if len(errors) == len(results):
+        e = errors[0]
+        readiness.mark("upstream", seconds, f"{e.__class__.__name__}: {e}")
+        print(f"[warmup] upstream unreachable: {e.__class__.__name__}: {e}", file=sys.stderr, flush=True)
+        return False
+    readiness.mark("upstream", seconds)
+    print(f"[warmup] upstream: {len(results) - len(errors)}/{len(results)} connections in {seconds:.2f}s", flush=True)
+    return True
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fill or check the tiktoken cache and time the local warm-up.")
+    parser.add_argument("--cache-dir", default=APP_TIKTOKEN_CACHE)
+    parser.add_argument("--fetch", action="store_true", help="download the BPE tables into --cache-dir")
+    args = parser.parse_args(argv)
+
+    cache = use_tiktoken_cache(args.cache_dir, create=args.fetch)
+    print(f"[warmup] tiktoken cache: {cache or 'tiktoken default'}", flush=True)
+    ok = warm_local()
+    print(json.dumps(readiness.snapshot(), indent=2))
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())